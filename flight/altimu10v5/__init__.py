@@ -9,19 +9,24 @@ Derived from https://github.com/SvetoslavKuzmanov/altimu10v5/blob/master/altimu1
 Adapted by eckp, referencing similar libraries like https://github.com/tkurbad/mipSIE/tree/master/python/AltIMU-10v5
 '''
 
+import threading
 from .lsm6ds33 import LSM6DS33
 from .lis3mdl import LIS3MDL
 from .lps25h import LPS25H
+from .i2c import SMBus
+from . import calibration
 
 
 class IMU(object):
     '''Set up and control Pololu's AltIMU-10v5.'''
 
-    def __init__(self):
+    def __init__(self, bus_id=1, bus=None):
         super(IMU, self).__init__()
-        self.lsm6ds33 = LSM6DS33()
-        self.lis3mdl = LIS3MDL()
-        self.lps25h = LPS25H()
+        # one bus handle for all devices, so the accesses to it can be serialized by a single reader
+        bus = SMBus(bus_id) if bus is None else bus
+        self.lsm6ds33 = LSM6DS33(bus_id, bus)
+        self.lis3mdl = LIS3MDL(bus_id, bus)
+        self.lps25h = LPS25H(bus_id, bus)
         self.enabled = False
         self.calibrated = False
 
@@ -30,6 +35,10 @@ class IMU(object):
         del(self.lis3mdl)
         del(self.lps25h)
 
+    def present(self):
+        '''Return whether all devices answer on the bus, probed by reading their WHO_AM_I registers.'''
+        return all(device.present() for device in (self.lsm6ds33, self.lis3mdl, self.lps25h))
+
     def enable(self):
         '''Enable all devices.'''
         self.lsm6ds33.enable()
@@ -37,8 +46,44 @@ class IMU(object):
         self.lis3mdl.enable()
         self.enabled = True
 
-    def calibrate(self):
-        '''Calibrate the devices that require calibration.'''
-        self.lsm6ds33.calibrate()
-        self.lps25h.calibrate()
+    def calibrate(self, gyro_tolerance=0.5, baro_tolerance=0.5, timeout=15,
+                  cache=None, max_age=3600, max_temperature_delta=2):
+        '''Calibrate the devices that require calibration, the gyro and barometer concurrently,
+        each until its mean converged to its tolerance (in LSB and Pa), or for at most timeout seconds.
+        If a cache filename is given, a gyro calibration stored there is reused if it is at most max_age seconds old,
+        taken with the same gyro settings, and at most max_temperature_delta degrees from the current temperature,
+        otherwise the new gyro calibration is stored there.
+        The barometer is always calibrated, as its reference pressure changes with the weather and the launch site.
+        Return a dict with the gyro calibration, the reference pressure, the temperature,
+        and the number of samples each took (0 for a cached calibration).
+        '''
+        temperature = self.lsm6ds33.get_temperature()
+        cached = cache and calibration.load_cache(cache, max_age, temperature, max_temperature_delta)
+        if cached and cached.get('gyro_settings') != self.lsm6ds33.settings[self.lsm6ds33.CTRL2_G]:
+            cached = None
+        results = {}
+
+        def calibrate_gyro():
+            try:
+                results['gyro'] = self.lsm6ds33.calibrate(gyro_tolerance, timeout=timeout)
+            except Exception as e:
+                results['error'] = e
+        threads = []
+        if cached:
+            self.lsm6ds33.set_gyro_calibration(cached['gyro_cal'])
+        else:
+            # the I2C transactions of both threads are serialized by the bus driver
+            threads.append(threading.Thread(target=calibrate_gyro, name='gyro calibration'))
+            threads[-1].start()
+        baro = self.lps25h.calibrate(baro_tolerance, timeout=timeout)
+        for thread in threads:
+            thread.join()
+        if 'error' in results:
+            raise results['error']
+
+        if cache and not cached and results['gyro'].count:
+            calibration.save_cache(cache, {'gyro_cal': self.lsm6ds33.gyro_cal, 'temperature': temperature,
+                                           'gyro_settings': self.lsm6ds33.settings[self.lsm6ds33.CTRL2_G]})
         self.calibrated = True
+        return {'gyro_cal': self.lsm6ds33.gyro_cal, 'p0': self.lps25h.p0, 'temperature': temperature,
+                'gyro_samples': results['gyro'].count if 'gyro' in results else 0, 'baro_samples': baro.count}
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+'''altimu10v5: Convergent calibration
+
+The sensor offsets are averaged with a running (Welford) mean and variance,
+until the standard error of the mean is below a tolerance, instead of over a fixed number of samples,
+so a quiet sensor is calibrated in a fraction of the time.
+Calibrations can be cached in a json file, to be reused while they are recent and the temperature is close.
+'''
+
+import json
+import math
+import time
+
+
+class RunningStats:
+    '''Running mean and sample variance of vectors of n values (Welford's algorithm),
+in constant memory and without the cancellation of summing squares.'''
+    def __init__(self, n):
+        self.count = 0
+        self.mean = [0.0]*n
+        self.m2 = [0.0]*n  # sums of the squared differences from the mean
+
+    def add(self, values):
+        '''Add one vector of n values.'''
+        self.count += 1
+        for i, x in enumerate(values):
+            delta = x - self.mean[i]
+            self.mean[i] += delta/self.count
+            self.m2[i] += delta*(x - self.mean[i])
+
+    @property
+    def variance(self):
+        '''Sample variance of every value.'''
+        return [m2/(self.count-1) if self.count > 1 else math.inf for m2 in self.m2]
+
+    @property
+    def standard_error(self):
+        '''Standard error of the mean of every value.'''
+        return [math.sqrt(variance/self.count) for variance in self.variance]
+
+    def converged(self, tolerance, min_samples=2):
+        '''Return whether the standard errors of all means are at most tolerance, after at least min_samples.'''
+        return self.count >= max(2, min_samples) and max(self.standard_error) <= tolerance
+
+
+def converge(read, n, tolerance, min_samples, max_samples, timeout, poll_interval):
+    '''Return the RunningStats of the samples returned by read, a function returning a (possibly empty) list
+    of new samples of n values, once the mean converged to tolerance, after max_samples, or after timeout seconds.
+    The loop sleeps poll_interval seconds whenever read returned nothing new.
+    '''
+    stats = RunningStats(n)
+    deadline = time.monotonic() + timeout
+    while stats.count < max_samples and not stats.converged(tolerance, min_samples):
+        samples = read()
+        for sample in samples:
+            stats.add(sample)
+        if time.monotonic() > deadline:
+            break
+        if not samples:
+            time.sleep(poll_interval)
+    return stats
+
+
+def load_cache(filename, max_age, temperature=None, max_temperature_delta=None):
+    '''Return the calibration dict cached in filename, or None if there is none,
+    it is older than max_age seconds, or was taken more than max_temperature_delta degrees from temperature.
+    The temperature check is skipped if temperature or max_temperature_delta is None.
+    '''
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not 0 <= time.time() - cache.get('time', 0) <= max_age:
+        return None
+    if temperature is not None and max_temperature_delta is not None\
+       and abs(cache.get('temperature', math.inf) - temperature) > max_temperature_delta:
+        return None
+    return cache
+
+
+def save_cache(filename, calibration):
+    '''Store a calibration dict in filename, stamped with the current time.'''
+    with open(filename, 'w') as f:
+        json.dump(dict(calibration, time=time.time()), f)
@@ -7,15 +7,29 @@ Derived from https://github.com/SvetoslavKuzmanov/altimu10v5/blob/master/altimu1
 Adapted by eckp
 '''
 
-from smbus import SMBus
+import struct
+try:
+    from smbus import SMBus
+except ImportError:
+    # allows importing the drivers on a dev box, where a stand-in bus (e.g. dummy.SMBus) is passed instead
+    SMBus = None
 
 
 class I2C(object):
     '''Class to set up and access I2C devices.'''
 
-    def __init__(self, bus_id=1):
-        '''Initialize the I2C bus.'''
-        self._i2c = SMBus(bus_id)
+    # bit to set in the register address to make the device auto increment it during block reads.
+    # The LPS25H and LIS3MDL use the MSB of the sub-address for this,
+    # the LSM6DS33 does it by itself as long as IF_INC is set in CTRL3_C.
+    AUTO_INCREMENT = 0x00
+
+    def __init__(self, bus_id=1, bus=None):
+        '''Initialize the I2C bus, or use the given (already opened) bus object.'''
+        self._i2c = SMBus(bus_id) if bus is None else bus
+        # read output registers in one block transaction when they are adjacent,
+        # set to False to fall back to one transaction per register
+        self.block_reads = True
+        self._block_structs = {}  # {(status register, registers): (struct, n_regs per value)}, see block_struct
 
     def __del__(self):
         '''Clean up.'''
@@ -32,10 +46,21 @@ class I2C(object):
         self._i2c.write_byte_data(address, register, value)
         return value_old
 
+    def present(self):
+        '''Return whether the device answers at its address (ADDR) with its WHO_AM_I register value (ID).'''
+        try:
+            return self.read_register(self.ADDR, self.WHO_AM_I) == self.ID
+        except OSError:
+            return False
+
     def read_register(self, address, register):
         '''Read a single I2C register.'''
         return self._i2c.read_byte_data(address, register)
 
+    def read_block(self, address, register, length):
+        '''Read length consecutive registers starting at register in one I2C transaction.'''
+        return self._i2c.read_i2c_block_data(address, register | self.AUTO_INCREMENT, length)
+
     def combine_bytes(self, *bytes):
         '''Combine (optional extra low,) low and high bytes to an unsigned 16 or 24 bit value. 
         Requires the bytes to be input from low to high.
@@ -51,13 +76,73 @@ class I2C(object):
         '''
         combined = self.combine_bytes(*bytes)
         return combined if combined < 2**(8*len(bytes)-1) else (combined - 2**(8*len(bytes)))
-        
+
+    def block_struct(self, registers, n_axes, status_register=None):
+        '''Return the struct to decode the block of registers into n_axes signed values,
+        and the number of registers per value, or None if the registers are not adjacent.
+        If a status register shortly before the registers is given, the block starts there,
+        and its value is decoded as the first (unsigned) value, skipping the registers in between.
+        The results are cached per register list, as they are looked up on every read.
+        '''
+        key = (status_register, tuple(registers))
+        try:
+            return self._block_structs[key]
+        except KeyError:
+            pass
+        n_regs = len(registers)//n_axes
+        gap = registers[0]-status_register-1 if status_register is not None else 0
+        if key[1] != tuple(range(registers[0], registers[0]+len(registers))) or n_regs not in (2, 3)\
+           or not 0 <= gap <= 16:
+            plan = None
+        else:
+            # 24 bit values are decoded as the unsigned extra low byte and the signed 16 bit upper part
+            prefix = '' if status_register is None else 'B'+'x'*gap
+            plan = (struct.Struct('<' + prefix + ('h' if n_regs == 2 else 'Bh')*n_axes), n_regs)
+        self._block_structs[key] = plan
+        return plan
+
+    def decode_values(self, values, n_regs):
+        '''Combine the values unpacked by a block struct into signed 16 or 24 bit values.'''
+        if n_regs == 2:
+            return list(values)
+        return [values[i+1]<<8 | values[i] for i in range(0, len(values), 2)]
+
+    def read_nd(self, address, registers, n_axes):
+        '''Return a list with the combined raw signed 16 or 24 bit values
+        of the n_axes values stored in registers, ordered like for read_3d.
+        Adjacent registers are fetched in one block transaction and decoded with one struct.unpack,
+        otherwise (or if block_reads is disabled) every register is read separately.
+        '''
+        plan = self.block_reads and self.block_struct(registers, n_axes)
+        if not plan:
+            n_regs = len(registers)//n_axes
+            return [self.combine_signed(*[self.read_register(address, reg) for reg in registers[i:i+n_regs]])
+                    for i in range(0, n_axes*n_regs, n_regs)]
+        unpacker, n_regs = plan
+        return self.decode_values(unpacker.unpack(bytes(self.read_block(address, registers[0], len(registers)))),
+                                  n_regs)
+
+    def read_nd_ready(self, address, status_register, mask, registers, n_axes):
+        '''Return read_nd of the registers only if the status register flags new data (any of the mask bits),
+        or None if the sensor has not finished a new conversion since the last read.
+        If the status register closely precedes the registers, both are fetched in one block transaction.
+        '''
+        plan = self.block_reads and self.block_struct(registers, n_axes, status_register)
+        if not plan:
+            if not self.read_register(address, status_register) & mask:
+                return None
+            return self.read_nd(address, registers, n_axes)
+        unpacker, n_regs = plan
+        values = unpacker.unpack(bytes(self.read_block(address, status_register, unpacker.size)))
+        if not values[0] & mask:
+            return None
+        return self.decode_values(values[1:], n_regs)
+
     def read_1d(self, address, registers):
         '''Return a vector with the combined raw signed 16 or 24 bit values
         of the output registers of a 1d sensor, depending on the number of registers.
         '''
-        bytes = [self.read_register(address, reg) for reg in registers]
-        return self.combine_signed(*bytes)
+        return self.read_nd(address, registers, 1)[0]
     
     def read_3d(self, address, registers):
         '''Return a vector with the combined raw signed 16 or 24 bit values
@@ -66,8 +151,4 @@ class I2C(object):
         registers = [[(x_reg_xlo), x_reg_lo, x_reg_hi], [(y_reg_xlo), y_reg_lo, y_reg_hi], [z_...]]
         where the extra low register is optional.
         '''
-        n_regs = len(registers)//3
-        x_val = self.read_1d(address, registers[0:n_regs])
-        y_val = self.read_1d(address, registers[n_regs:2*n_regs])
-        z_val = self.read_1d(address, registers[2*n_regs:3*n_regs])
-        return [x_val, y_val, z_val]
+        return self.read_nd(address, registers, 3)
@@ -20,10 +20,12 @@ class LIS3MDL(I2C):
     '''Set up and access LIS3MDL magnetometer.'''
 
     ADDR = 0x1e  # Magnetometer I2C device address
+    ID = 0x3d  # value of the WHO_AM_I register
+    AUTO_INCREMENT = 0x80  # MSB of the register address enables auto increment for block reads
 
     # Register addresses
     #  ([+] = used in the code, [-] = not used or useful, [ ] = TBD)
-    WHO_AM_I    = 0x0F   # [-] Returns 0x3d (read only)
+    WHO_AM_I    = 0x0F   # [+] Returns 0x3d (read only)
 
     CTRL_REG1   = 0x20   # [+] Control register to enable device, set
                          #     operating modes and rates for X and Y axes
@@ -32,7 +34,7 @@ class LIS3MDL(I2C):
     CTRL_REG4   = 0x23   # [+] Set operating mode and rate for Z-axis
     CTRL_REG5   = 0x24   # [ ] Set fast read, block data update modes
 
-    STATUS_REG  = 0x27   # [ ] Read device status (Is new data available?)
+    STATUS_REG  = 0x27   # [+] Read device status (Is new data available?)
 
     OUT_X_L     = 0x28   # [+] X output, low byte
     OUT_X_H     = 0x29   # [+] X output, high byte
@@ -66,9 +68,15 @@ class LIS3MDL(I2C):
     ]
 
 
-    def __init__(self, bus_id=1):
+    # Magnetometer sensitivity in LSB/gauss per full scale code, as set in bits 6-5 of CTRL_REG2
+    mag_sensitivities = {0b00: 6842, 0b01: 3421, 0b10: 2281, 0b11: 1711}
+
+    # STATUS_REG flags for new data
+    ZYXDA = 0b00001000  # new data on all axes
+
+    def __init__(self, bus_id=1, bus=None):
         '''Set up I2C connection and initialize some flags and values.'''
-        super(LIS3MDL, self).__init__(bus_id)
+        super(LIS3MDL, self).__init__(bus_id, bus)
         self.mag_enabled = False
         self.lis_temp_enabled = False
 
@@ -111,6 +119,11 @@ class LIS3MDL(I2C):
         for register in self.settings:
             self.write_register(self.ADDR, register, self.settings[register])
         
+    @property
+    def mag_scale(self):
+        '''Magnetometer sensitivity in gauss/LSB at the configured full scale.'''
+        return 1/self.mag_sensitivities[(self.settings[self.CTRL_REG2]>>5) & 0b11]
+
     def get_magnetometer_raw(self):
         '''Return 3D vector of raw magnetometer data.'''
         # Check if magnetometer has been enabled
@@ -119,6 +132,15 @@ class LIS3MDL(I2C):
 
         return self.read_3d(self.ADDR, self.mag_registers)
 
+    def get_magnetometer_new(self):
+        '''Return 3D vector of raw magnetometer data if there is new data since the last read,
+        otherwise return None.
+        '''
+        if not self.mag_enabled:
+            raise(Exception('Magnetometer is not enabled'))
+
+        return self.read_nd_ready(self.ADDR, self.STATUS_REG, self.ZYXDA, self.mag_registers, 3)
+
     def get_temperature_raw(self):
         '''Return the raw temperature sensor data.'''
         if not self.lis_temp_enabled:
@@ -13,14 +13,17 @@ Derived from https://github.com/SvetoslavKuzmanov/altimu10v5/blob/master/altimu1
 Adapted by eckp, referencing similar libraries like https://github.com/tkurbad/mipSIE/tree/master/python/AltIMU-10v5
 '''
 
+import time
 from .i2c import I2C
-from time import sleep
+from . import calibration
 
 
 class LPS25H(I2C):
     '''Set up and access LPS25H digital barometer.'''
 
     ADDR = 0x5d  # Barometric pressure I2C device address
+    ID = 0xbd  # value of the WHO_AM_I register
+    AUTO_INCREMENT = 0x80  # MSB of the register address enables auto increment for block reads
 
     # Register addresses
     #  ([+] = used in the code, [-] = not used or useful, [ ] = TBD)
@@ -28,19 +31,19 @@ class LPS25H(I2C):
     REF_P_L         = 0x09  # [ ] Reference pressure, low byte
     REF_P_H         = 0x0A  # [ ] Reference pressure, high byte
 
-    WHO_AM_I        = 0x0F  # [-] Returns 0xbd (read only)
+    WHO_AM_I        = 0x0F  # [+] Returns 0xbd (read only)
 
-    RES_CONF        = 0x10  # [ ] Set pressure and temperature resolution
+    RES_CONF        = 0x10  # [+] Set pressure and temperature resolution
 
     CTRL_REG1       = 0x20  # [+] Set device power mode / ODR / BDU
-    CTRL_REG2       = 0x21  # [-] FIFO / I2C configuration
+    CTRL_REG2       = 0x21  # [+] FIFO / I2C configuration
     CTRL_REG3       = 0x22  # [-] Interrupt configuration
     CTRL_REG4       = 0x23  # [-] Interrupt configuration
 
     INT_CFG         = 0x24  # [-] Interrupt configuration
     INT_SOURCE      = 0x25  # [-] Interrupt source configuration
 
-    STATUS_REG      = 0x27  # [ ] Status (new pressure/temperature data
+    STATUS_REG      = 0x27  # [+] Status (new pressure/temperature data
                             #     available)
 
     PRESS_OUT_XL    = 0x28  # [+] Pressure output, loweste byte
@@ -50,8 +53,8 @@ class LPS25H(I2C):
     TEMP_OUT_L      = 0x2B  # [+] Temperature output, low byte
     TEMP_OUT_H      = 0x2C  # [+] Temperature output, high byte
 
-    FIFO_CTRL       = 0x2E  # [ ] FIFO control / mode selection
-    FIFO_STATUS     = 0x2F  # [-] FIFO status
+    FIFO_CTRL       = 0x2E  # [+] FIFO control / mode selection
+    FIFO_STATUS     = 0x2F  # [+] FIFO status
 
     THS_P_L         = 0x30  # [-] Pressure interrupt threshold, low byte
     THS_P_H         = 0x31  # [-] Pressure interrupt threshold, high byte
@@ -82,17 +85,38 @@ class LPS25H(I2C):
         TEMP_OUT_H, # high byte of temperature value
     ]
 
+    # Output data rates in Hz per ODR code, as set in bits 6-4 of CTRL_REG1
+    odr_rates = {0b001: 1, 0b010: 7, 0b011: 12.5, 0b100: 25}
+
+    # RES_CONF codes for the number of internal pressure (AVGP) and temperature (AVGT) averages
+    pressure_averages = {8: 0b00, 32: 0b01, 128: 0b10, 512: 0b11}
+    temperature_averages = {8: 0b00, 16: 0b01, 32: 0b10, 64: 0b11}
+
+    # FIFO_CTRL WTM_POINT codes for the number of samples in the FIFO mean mode moving average
+    fifo_mean_samples = {2: 0b00001, 4: 0b00011, 8: 0b00111, 16: 0b01111, 32: 0b11111}
+
+    FIFO_SIZE = 32  # number of samples the FIFO can hold
+
+    baro_scale = 1/40.96  # pressure sensitivity in Pa/LSB
+
+    # STATUS_REG flags for new data
+    T_DA = 0b01  # new temperature data
+    P_DA = 0b10  # new pressure data
+
     
-    def __init__(self, bus_id=1):
+    def __init__(self, bus_id=1, bus=None):
         '''Set up and access LPS25H digital barometer.'''
-        super(LPS25H, self).__init__(bus_id)
+        super(LPS25H, self).__init__(bus_id, bus)
         self.baro_enabled = False
         self.lps_temp_enabled = False
 
         self.p0 = 101325  # standard sea level pressure in Pa as a first guesstimate
 
+        self.fifo_mode = None  # None (bypass), 'mean' or 'stream', see enable_fifo_mean and enable_fifo_stream
+
         # current control register settings, starting point are these defaults
-        self.settings = {self.CTRL_REG1: 0b10110000,
+        self.settings = {self.RES_CONF: 0b00000101,  # 32 pressure, 16 temperature averages
+                         self.CTRL_REG1: 0b10110000,
                          self.CTRL_REG2: 0b00000000,
                          self.CTRL_REG3: 0b00000000,
                          self.CTRL_REG4: 0b00000000}
@@ -130,17 +154,80 @@ class LPS25H(I2C):
 # TODO: this is not a calibration in the truest sense,
 #       as the sensor returns absolute readings w.r.t. a reference reservoir.
 #       Instead, this is an initialisation where the reference altitude is established...
-    def calibrate(self, samples=2000):
-        '''Measure the current ambient pressure 
-        by exponentially averaging n_samples pressure readings.'''
-        for i in range(samples):
-            self.p0 = 0.95*self.p0 + 0.05*(self.get_barometer_raw()/40.96)
-            sleep(0.004)
+    def calibrate(self, tolerance=0.5, min_samples=25, max_samples=2000, timeout=15):
+        '''Measure the current ambient pressure in Pa, by averaging the new pressure samples
+        until the standard error of the mean is below tolerance Pa (see calibration.converge).
+        The FIFO mean mode correlates consecutive samples, which makes the standard error too optimistic,
+        so it is best enabled after the calibration.
+        Return the RunningStats of the samples.
+        '''
+        def read():
+            sample = self.get_barometer_new()
+            return [[sample*self.baro_scale]] if sample is not None else []
+        stats = calibration.converge(read, 1, tolerance, min_samples, max_samples, timeout, self.period/2)
+
+        if stats.count:
+            self.p0 = stats.mean[0]
+            self.baro_calibrated = True
+        return stats
+
+    @property
+    def period(self):
+        '''Seconds between two samples at the configured ODR.'''
+        return 1/self.odr_rates[(self.settings[self.CTRL_REG1]>>4) & 0b111]
+
+    def set_averaging(self, pressure=32, temperature=16):
+        '''Set the number of internal averages per pressure and temperature sample in RES_CONF.
+        More averages lower the noise at the cost of power, not CPU time.
+        Note that 512 pressure averages are not allowed at 25 Hz.
+        '''
+        self.configure({self.RES_CONF: self.temperature_averages[temperature]<<2 | self.pressure_averages[pressure]})
+
+    def enable_fifo_mean(self, samples=8):
+        '''Let the output registers return the moving average of the last samples (2, 4, 8, 16 or 32)
+        from the FIFO, to smooth the pressure in hardware instead of in software.
+        '''
+        self.configure({self.FIFO_CTRL: 0b110<<5 | self.fifo_mean_samples[samples],  # FIFO mean mode
+                        self.CTRL_REG2: self.settings[self.CTRL_REG2] | 0b01000000})  # FIFO_EN
+        self.fifo_mode = 'mean'
+
+    def enable_fifo_stream(self):
+        '''Store the samples in the FIFO in stream mode, so they can be drained in bulk by read_fifo.
+        The FIFO holds 32 samples, so it needs to be drained at least every 32 ODR periods.
+        '''
+        # bypass mode first, which empties the FIFO
+        self.configure({self.FIFO_CTRL: 0b00000000})
+        self.configure({self.FIFO_CTRL: 0b010<<5,  # stream mode
+                        self.CTRL_REG2: self.settings[self.CTRL_REG2] | 0b01000000})  # FIFO_EN
+        self.fifo_mode = 'stream'
+
+    def disable_fifo(self):
+        '''Put the FIFO back in bypass mode, for polling the output registers.'''
+        self.configure({self.FIFO_CTRL: 0b00000000,
+                        self.CTRL_REG2: self.settings[self.CTRL_REG2] & ~0b01000000})
+        self.fifo_mode = None
+
+    def get_fifo_level(self):
+        '''Return the number of unread samples in the FIFO.'''
+        status = self.read_register(self.ADDR, self.FIFO_STATUS)
+        return self.FIFO_SIZE if status & 0b01000000 else status & 0b00011111
+
+    def read_fifo(self):
+        '''Drain all stored pressure samples from the FIFO, one block read per sample.
+        Return a list of [timestamp, pressure] rows, oldest first,
+        where the newest sample is stamped with the time.monotonic_ns() of the drain,
+        and the older ones are spaced by the ODR period before it.
+        '''
+        if self.fifo_mode != 'stream':
+            raise(Exception('FIFO stream mode is not enabled'))
+
+        n_samples = self.get_fifo_level()
+        now = time.monotonic_ns()
+        period = round(1e9*self.period)
+        # every read of the output registers pops the oldest sample from the FIFO
+        return [[now - (n_samples-1-i)*period, self.read_1d(self.ADDR, self.baro_registers)]
+                for i in range(n_samples)]
 
-        self.baro_calibrated = True
-        return self.p0
-
-            
     def get_barometer_raw(self):
         '''Return the raw barometer sensor data.'''
         # Check if barometer has been enabled
@@ -149,6 +236,16 @@ class LPS25H(I2C):
 
         return self.read_1d(self.ADDR, self.baro_registers)
 
+    def get_barometer_new(self):
+        '''Return the raw barometer sensor data if there is a new conversion since the last read,
+        otherwise return None.
+        '''
+        if not self.baro_enabled:
+            raise(Exception('Barometer is not enabled'))
+
+        sensor_data = self.read_nd_ready(self.ADDR, self.STATUS_REG, self.P_DA, self.baro_registers, 1)
+        return sensor_data and sensor_data[0]
+
     def get_temperature_raw(self):
         '''Return the raw temperature sensor data.'''
         if not self.lps_temp_enabled:
@@ -156,6 +253,10 @@ class LPS25H(I2C):
 
         return self.read_1d(self.ADDR, self.lps_temp_registers)
 
+    def get_temperature(self):
+        '''Return the temperature in degrees Celsius (480 LSB/degree, offset 42.5 degrees).'''
+        return 42.5 + self.get_temperature_raw()/480
+
     def get_all_raw(self):
         '''Return all sensor data.'''
         return [self.get_temperature_raw(), self.get_barometer_raw()]
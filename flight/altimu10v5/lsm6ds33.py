@@ -15,7 +15,10 @@ Adapted by eckp, referencing similar libraries like https://github.com/tkurbad/m
 '''
 
 import math
+import time
+import struct
 from .i2c import I2C
+from . import calibration
 from time import sleep
 
 
@@ -23,6 +26,7 @@ class LSM6DS33(I2C):
     '''Set up and access LSM6DS33 accelerometer and gyroscope.'''
 
     ADDR = 0x6b  # Gyroscope / accelerometer I2C device address
+    ID = 0x69  # value of the WHO_AM_I register
 
     # Register addresses
     #  ([+] = used in the code, [-] = not used or useful, [ ] = TBD)
@@ -30,16 +34,16 @@ class LSM6DS33(I2C):
                                   #     functions, e.g. pedometer
 
     FIFO_CTRL1        = 0x06  # [-] FIFO threshold setting
-    FIFO_CTRL2        = 0x07  # [-] FIFO control register
-    FIFO_CTRL3        = 0x08  # [-] Gyro/Acceleromter-specific FIFO settings
-    FIFO_CTRL4        = 0x09  # [-] FIFO data storage control
-    FIFO_CTRL5        = 0x0A  # [-] FIFO ODR/Mode selection
+    FIFO_CTRL2        = 0x07  # [+] FIFO control register
+    FIFO_CTRL3        = 0x08  # [+] Gyro/Acceleromter-specific FIFO settings
+    FIFO_CTRL4        = 0x09  # [+] FIFO data storage control
+    FIFO_CTRL5        = 0x0A  # [+] FIFO ODR/Mode selection
 
     ORIENT_CFG_G      = 0x0B  # [ ] Gyroscope sign/orientation
 
     INT1_CTRL         = 0x0D  # [-] INT1 pad control - unavailable for AltIMU
     INT2_CTRL         = 0x0E  # [-] INT2 pad control - unavailable for AltIMU
-    WHO_AM_I          = 0x0F  # [-] Returns 0x69 (read only)
+    WHO_AM_I          = 0x0F  # [+] Returns 0x69 (read only)
     CTRL1_XL          = 0x10  # [+] Acceleration sensor control
     CTRL2_G           = 0x11  # [+] Angular rate sensor (gyroscope) control
     CTRL3_C           = 0x12  # [+] Device/communication settings
@@ -49,13 +53,13 @@ class LSM6DS33(I2C):
     CTRL7_G           = 0x16  # [ ] Gyroscope performance/power mode settings
     CTRL8_XL          = 0x17  # [ ] Acceleration sensor settings
     CTRL9_XL          = 0x18  # [ ] Acceleration sensor axis control
-    CTRL10_C          = 0x19  # [ ] Gyroscope axis control / misc. settings
+    CTRL10_C          = 0x19  # [+] Gyroscope axis control / misc. settings
 
     WAKE_UP_SRC       = 0x1B  # [-] Wake up interrupt source register
     TAP_SRC           = 0x1C  # [-] Tap source register
     D6D_SRC           = 0x1D  # [-] Orientation sensing for Android devices
 
-    STATUS_REG        = 0x1E  # [ ] Status register. Shows if new data
+    STATUS_REG        = 0x1E  # [+] Status register. Shows if new data
                                   #     is available from one or more of the
                                   #     sensors
 
@@ -74,16 +78,16 @@ class LSM6DS33(I2C):
     OUTZ_L_XL         = 0x2C  # [+] Accelerometer Z output, low byte
     OUTZ_H_XL         = 0x2D  # [+] Accelerometer Z output, high byte
 
-    FIFO_STATUS1      = 0x3A  # [-] Number of unread words in FIFO
-    FIFO_STATUS2      = 0x3B  # [-] FIFO status control register
-    FIFO_STATUS3      = 0x3C  # [-] FIFO status control register
-    FIFO_STATUS4      = 0x3D  # [-] FIFO status control register
-    FIFO_DATA_OUT_L   = 0x3E  # [-] FIFO data output, low byte
-    FIFO_DATA_OUT_H   = 0x3F  # [-] FIFO data output, high byte
+    FIFO_STATUS1      = 0x3A  # [+] Number of unread words in FIFO
+    FIFO_STATUS2      = 0x3B  # [+] FIFO status control register
+    FIFO_STATUS3      = 0x3C  # [+] FIFO status control register
+    FIFO_STATUS4      = 0x3D  # [+] FIFO status control register
+    FIFO_DATA_OUT_L   = 0x3E  # [+] FIFO data output, low byte
+    FIFO_DATA_OUT_H   = 0x3F  # [+] FIFO data output, high byte
 
-    TIMESTAMP0_REG    = 0x40  # [-] Time stamp first byte data output
-    TIMESTAMP1_REG    = 0x41  # [-] Time stamp second byte data output
-    TIMESTAMP2_REG    = 0x42  # [-] Time stamp third byte data output
+    TIMESTAMP0_REG    = 0x40  # [+] Time stamp first byte data output
+    TIMESTAMP1_REG    = 0x41  # [+] Time stamp second byte data output
+    TIMESTAMP2_REG    = 0x42  # [+] Time stamp third byte data output
 
     STEP_TIMESTAMP_L  = 0x49  # [-] Time stamp of last step (for pedometer)
     STEP_TIMESTAMP_H  = 0x4A  # [-] Time stamp of last step, high byte
@@ -93,11 +97,11 @@ class LSM6DS33(I2C):
     FUNC_SRC          = 0x53  # [-] Interrupt source register for
                               #     embedded functions
 
-    TAP_CFG           = 0x58  # [-] Configuration of embedded functions
+    TAP_CFG           = 0x58  # [+] Configuration of embedded functions
     TAP_THS_6D        = 0x59  # [-] Orientation and tap threshold
     INT_DUR2          = 0x5A  # [-] Tap recognition settings
     WAKE_UP_THS       = 0x5B  # [-] Wake up threshold settings
-    WAKE_UP_DUR       = 0x5C  # [-] Wake up function settings
+    WAKE_UP_DUR       = 0x5C  # [+] Wake up function settings
     FREE_FALL         = 0x5D  # [-] Free fall duration settings
     MD1_CFG           = 0x5E  # [-] Function routing for INT1
     MD2_CFG           = 0x5F  # [-] Function routing for INT2
@@ -128,9 +132,47 @@ class LSM6DS33(I2C):
         OUT_TEMP_H,  # high byte of temperature value
     ]
 
-    def __init__(self, bus_id=1):
+    # Registers read at once to get the FIFO fill level and pattern
+    fifo_status_registers = [
+        FIFO_STATUS1,  # low byte of the number of unread words
+        FIFO_STATUS2,  # flags and high bits of the number of unread words
+        FIFO_STATUS3,  # low byte of the pattern index of the next word
+        FIFO_STATUS4,  # high bits of the pattern index of the next word
+    ]
+
+    # Registers of the 24 bit timestamp counter
+    timestamp_registers = [
+        TIMESTAMP0_REG,  # low byte of the timestamp
+        TIMESTAMP1_REG,  # middle byte of the timestamp
+        TIMESTAMP2_REG,  # high byte of the timestamp
+    ]
+
+    # Output data rates in Hz per ODR code, as set in the upper nibble of CTRL1_XL/CTRL2_G.
+    # The ODR_FIFO codes of FIFO_CTRL5 use the same numbering.
+    odr_rates = {0b0001: 12.5, 0b0010: 26, 0b0011: 52, 0b0100: 104, 0b0101: 208,
+                 0b0110: 416, 0b0111: 833, 0b1000: 1660, 0b1001: 3330, 0b1010: 6660}
+
+    # Accelerometer sensitivity in g/LSB per full scale code, as set in bits 3-2 of CTRL1_XL
+    acc_scales = {0b00: 0.061e-3, 0b01: 0.488e-3, 0b10: 0.122e-3, 0b11: 0.244e-3}
+    # Gyro sensitivity in dps/LSB per full scale code, as set in bits 3-2 of CTRL2_G (unless FS_125 is set)
+    gyro_scales = {0b00: 8.75e-3, 0b01: 17.5e-3, 0b10: 35e-3, 0b11: 70e-3}
+
+    # STATUS_REG flags for new data
+    XLDA = 0b001  # new accelerometer data
+    GDA  = 0b010  # new gyroscope data
+    TDA  = 0b100  # new temperature data
+
+    FIFO_WORDS_PER_SAMPLE = 9  # gyro xyz, accelerometer xyz and the timestamp data set, without decimation
+                               # (so both ODRs must equal the FIFO ODR, see enable_fifo)
+    # a FIFO sample: gyro xyz, accelerometer xyz, and the timestamp data set of timestamp middle and high byte,
+    # an unused byte, the timestamp low byte, and the step counter
+    FIFO_SAMPLE = struct.Struct('<6hBBxBxx')
+    FIFO_BLOCK_WORDS = 16  # words per block read, limited by the 32 byte SMBus block size
+    TIMESTAMP_RESOLUTION = 25000  # nanoseconds per timestamp tick, with TIMER_HR set in WAKE_UP_DUR
+
+    def __init__(self, bus_id=1, bus=None):
         '''Set up I2C connection and initialize some flags and values.'''
-        super(LSM6DS33, self).__init__(bus_id)
+        super(LSM6DS33, self).__init__(bus_id, bus)
         self.gyro_enabled = False
         self.acc_enabled = False
         self.lsm_temp_enabled = False
@@ -138,10 +180,14 @@ class LSM6DS33(I2C):
         self.gyro_calibrated = False
         self.gyro_cal = [0, 0, 0]
 
+        self.fifo_enabled = False
+        self.fifo_overruns = 0  # number of drains that found the FIFO overrun (samples lost)
+
         # current control register settings, starting point are these defaults
         self.settings = {self.FIFO_CTRL5: 0b00000000,
                          self.CTRL1_XL: 0b01010100,  # 208 Hz, +-16g
                          self.CTRL2_G: 0b01010100,  # 208 Hz, +-500 dps
+                         self.CTRL3_C: 0b00000100,  # IF_INC: auto increment for block reads
                          self.CTRL6_C: 0b00000000,
                          self.CTRL7_G: 0b00000000}
 
@@ -179,40 +225,174 @@ class LSM6DS33(I2C):
         for register in self.settings:
             self.write_register(self.ADDR, register, self.settings[register])
 
-    def calibrate(self, samples=2000):
-        '''Calibrate the gyro's raw values.'''
-        for i in range(samples):
-            gyro_raw = self.get_gyroscope_raw()
-
-            self.gyro_cal[0] += gyro_raw[0]
-            self.gyro_cal[1] += gyro_raw[1]
-            self.gyro_cal[2] += gyro_raw[2]
-
-            sleep(0.004)
-
-        self.gyro_cal[0] /= samples
-        self.gyro_cal[1] /= samples
-        self.gyro_cal[2] /= samples
-
+    def calibrate(self, tolerance=0.5, min_samples=100, max_samples=2000, timeout=15, fifo=True):
+        '''Calibrate the gyro's raw values, by averaging the raw gyro samples until the standard error
+        of the mean is below tolerance LSB on every axis (see calibration.converge).
+        With fifo, the samples are drained in block reads from the FIFO, which is disabled again afterwards
+        unless it was already enabled, otherwise every new sample is polled by a status-gated read.
+        The FIFO is only used if the gyro and accelerometer run at the same ODR (see enable_fifo).
+        Return the RunningStats of the samples.
+        '''
+        was_enabled = self.fifo_enabled
+        fifo = fifo and self.settings[self.CTRL1_XL]>>4 == self.settings[self.CTRL2_G]>>4
+        if fifo and not was_enabled:
+            self.enable_fifo(self.settings[self.CTRL2_G]>>4)
+
+        if self.fifo_enabled:
+            read = lambda: [row[1:4] for row in self.read_fifo(calibrated=False)]
+        else:
+            def read():
+                sample = self.get_gyroscope_new(calibrated=False)
+                return [sample] if sample else []
+        # the FIFO holds over 300 samples, so it only needs to be drained every few sample periods
+        stats = calibration.converge(read, 3, tolerance, min_samples, max_samples, timeout,
+                                     self.gyro_period/2 if not self.fifo_enabled else 10*self.gyro_period)
+
+        if fifo and not was_enabled:
+            self.disable_fifo()
+        if stats.count:
+            self.gyro_cal = stats.mean
+            self.gyro_calibrated = True
+        return stats
+
+    def set_gyro_calibration(self, gyro_cal):
+        '''Use a previously measured gyro calibration (like a cached one).'''
+        self.gyro_cal = list(gyro_cal)
         self.gyro_calibrated = True
 
-    def get_gyroscope_raw(self):
-        '''Return a 3D vector of raw gyro data.'''
+    def enable_fifo(self, odr=None):
+        '''Store the gyro and accelerometer samples in the FIFO in continuous mode,
+        so they can be drained in bulk by read_fifo instead of being polled one at a time.
+        The FIFO runs at the given ODR code, or at the accelerometer ODR code by default.
+        read_fifo expects a gyro and an accelerometer sample in every FIFO sample, without decimation,
+        so both ODRs must equal the FIFO ODR, otherwise a ValueError is raised.
+        The timestamp counter is enabled (and reset), and stored with every sample as the fourth data set.
+        '''
+        odr = odr or self.settings[self.CTRL1_XL]>>4
+        acc_odr, gyro_odr = self.settings[self.CTRL1_XL]>>4, self.settings[self.CTRL2_G]>>4
+        if odr not in self.odr_rates or acc_odr != odr or gyro_odr != odr:
+            raise ValueError('The FIFO ODR code {:#06b} must equal the accelerometer ({:#06b}) and gyro ({:#06b}) '
+                             'ODR codes'.format(odr, acc_odr, gyro_odr))
+        # bypass mode first, which empties the FIFO
+        self.write_register(self.ADDR, self.FIFO_CTRL5, 0b00000000)
+        self.configure({self.CTRL10_C: 0b00000100,  # FUNC_EN: enable the embedded functions, incl. the timestamp
+                        self.TAP_CFG: 0b10000000,  # TIMER_EN: enable timestamp counter
+                        self.WAKE_UP_DUR: 0b00010000,  # TIMER_HR: 25 us timestamp resolution
+                        self.FIFO_CTRL2: 0b10000000,  # TIMER_PEDO_FIFO_EN: timestamp as fourth data set
+                        self.FIFO_CTRL3: 0b00001001,  # no decimation for gyro and accelerometer
+                        self.FIFO_CTRL4: 0b00001000,  # no decimation for the timestamp data set
+                        self.FIFO_CTRL5: odr<<3 | 0b110})  # FIFO ODR, continuous mode
+        self.write_register(self.ADDR, self.TIMESTAMP2_REG, 0xAA)  # reset the timestamp counter
+        self.fifo_enabled = True
+
+    def disable_fifo(self):
+        '''Put the FIFO back in bypass mode, for polling the output registers.'''
+        self.configure({self.FIFO_CTRL5: 0b00000000})
+        self.fifo_enabled = False
+
+    def get_fifo_status(self):
+        '''Return the number of unread words in the FIFO, the pattern index of the next word,
+        and whether the FIFO has overrun.
+        '''
+        status = self.read_block(self.ADDR, self.FIFO_STATUS1, len(self.fifo_status_registers))
+        unread = (status[1] & 0x0f)<<8 | status[0]
+        pattern = (status[3] & 0x03)<<8 | status[2]
+        return unread, pattern, bool(status[1] & 0x40)
+
+    def get_timestamp(self):
+        '''Return the 24 bit timestamp counter of the sensor, in ticks of TIMESTAMP_RESOLUTION,
+        and the time.monotonic_ns() at which it was read (halfway the read).
+        '''
+        before = time.monotonic_ns()
+        raw = self.read_block(self.ADDR, self.TIMESTAMP0_REG, len(self.timestamp_registers))
+        return self.combine_bytes(*raw), (before + time.monotonic_ns())//2
+
+    def read_fifo(self, calibrated=True):
+        '''Drain all complete samples from the FIFO in block reads.
+        Return a list of [timestamp, gyro x, y, z, accelerometer x, y, z] rows, oldest first,
+        with the gyro calibration subtracted unless calibrated is False.
+        Every sample is stamped with the timestamp counter stored with it in the FIFO,
+        converted to time.monotonic_ns() against the counter read at every drain,
+        so the sample times keep the spacing of the sensor and don't drift from the monotonic clock.
+        '''
+        if not self.fifo_enabled:
+            raise(Exception('FIFO is not enabled!'))
+
+        unread, pattern, overrun = self.get_fifo_status()
+        # read after the status, so all drained samples are older than the counter
+        ticks, now = self.get_timestamp()
+        if overrun:
+            self.fifo_overruns += 1
+
+        # skip the words of a partially read sample, so the drain starts at gyro x
+        skip = (self.FIFO_WORDS_PER_SAMPLE - pattern) % self.FIFO_WORDS_PER_SAMPLE
+        for i in range(min(skip, unread)):
+            self.read_block(self.ADDR, self.FIFO_DATA_OUT_L, 2)
+        n_samples = max(0, unread - skip)//self.FIFO_WORDS_PER_SAMPLE
+
+        data = bytearray()
+        n_words = n_samples*self.FIFO_WORDS_PER_SAMPLE
+        # the FIFO_DATA_OUT address rolls over from high to low byte, so the whole block is FIFO data,
+        # and the blocks don't need to end on a sample, since the words are read in the FIFO pattern order
+        for i in range(0, n_words, self.FIFO_BLOCK_WORDS):
+            data += bytes(self.read_block(self.ADDR, self.FIFO_DATA_OUT_L, 2*min(self.FIFO_BLOCK_WORDS, n_words-i)))
+
+        rows = []
+        for *sample, middle, high, low in self.FIFO_SAMPLE.iter_unpack(data):
+            # the age of the sample in ticks, modulo the wrap around of the counter
+            age = (ticks - (high<<16 | middle<<8 | low)) % 2**24
+            rows.append([now - age*self.TIMESTAMP_RESOLUTION, *self.apply_gyro_calibration(sample, calibrated)])
+        return rows
+
+    @property
+    def period(self):
+        '''Seconds between two samples at the configured accelerometer ODR.'''
+        return 1/self.odr_rates[self.settings[self.CTRL1_XL]>>4]
+
+    @property
+    def gyro_period(self):
+        '''Seconds between two samples at the configured gyro ODR.'''
+        return 1/self.odr_rates[self.settings[self.CTRL2_G]>>4]
+
+    @property
+    def acc_scale(self):
+        '''Accelerometer sensitivity in g/LSB at the configured full scale.'''
+        return self.acc_scales[(self.settings[self.CTRL1_XL]>>2) & 0b11]
+
+    @property
+    def gyro_scale(self):
+        '''Gyro sensitivity in dps/LSB at the configured full scale.'''
+        if self.settings[self.CTRL2_G] & 0b10:
+            return 4.375e-3
+        return self.gyro_scales[(self.settings[self.CTRL2_G]>>2) & 0b11]
+
+    def get_gyroscope_raw(self, calibrated=True):
+        '''Return a 3D vector of raw gyro data,
+        with the calibration subtracted unless calibrated is False.
+        '''
         # Check if gyroscope has been enabled
         if not self.gyro_enabled:
             raise(Exception('Gyroscope is not enabled!'))
 
-        sensor_data = self.read_3d(self.ADDR, self.gyro_registers)
+        return self.apply_gyro_calibration(self.read_3d(self.ADDR, self.gyro_registers), calibrated)
 
-        # Return the vector
-        if self.gyro_calibrated:
-            calibrated_gyro_data = sensor_data
-            calibrated_gyro_data[0] -= self.gyro_cal[0]
-            calibrated_gyro_data[1] -= self.gyro_cal[1]
-            calibrated_gyro_data[2] -= self.gyro_cal[2]
-            return calibrated_gyro_data
-        else:
-            return sensor_data
+    def get_gyroscope_new(self, calibrated=True):
+        '''Return a 3D vector of raw gyro data if the gyro has new data since the last read,
+        otherwise return None.
+        '''
+        if not self.gyro_enabled:
+            raise(Exception('Gyroscope is not enabled!'))
+
+        sensor_data = self.read_nd_ready(self.ADDR, self.STATUS_REG, self.GDA, self.gyro_registers, 3)
+        return sensor_data and self.apply_gyro_calibration(sensor_data, calibrated)
+
+    def apply_gyro_calibration(self, sensor_data, calibrated=True):
+        '''Subtract the gyro calibration from a 3D vector of raw gyro data, if calibrated.'''
+        if self.gyro_calibrated and calibrated:
+            sensor_data[0] -= self.gyro_cal[0]
+            sensor_data[1] -= self.gyro_cal[1]
+            sensor_data[2] -= self.gyro_cal[2]
+        return sensor_data
 
     def get_accelerometer_raw(self):
         '''Return a 3D vector of raw accelerometer data.'''
@@ -222,6 +402,15 @@ class LSM6DS33(I2C):
 
         return self.read_3d(self.ADDR, self.acc_registers)
 
+    def get_accelerometer_new(self):
+        '''Return a 3D vector of raw accelerometer data if the accelerometer has new data since the last read,
+        otherwise return None.
+        '''
+        if not self.acc_enabled:
+            raise(Exception('Accelerometer is not enabled!'))
+
+        return self.read_nd_ready(self.ADDR, self.STATUS_REG, self.XLDA, self.acc_registers, 3)
+
     def get_temperature_raw(self):
         '''Return the raw temperature sensor data.'''
         if not self.lsm_temp_enabled:
@@ -229,7 +418,10 @@ class LSM6DS33(I2C):
 
         return self.read_1d(self.ADDR, self.lsm_temp_registers)
 
-        
+    def get_temperature(self):
+        '''Return the temperature in degrees Celsius (16 LSB/degree, 0 at 25 degrees).'''
+        return 25 + self.get_temperature_raw()/16
+
     def get_all_raw(self):
         '''Return all sensor values in a flat list.'''
         return [self.get_temperature_raw(),
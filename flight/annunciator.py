@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+'''
+Background annunciator, that plays beep and light patterns on the buzzer and status LED from its own thread,
+so the state machine never sleeps while a pattern plays.
+'''
+
+import heapq
+import itertools
+import threading
+import logging
+
+# because this is a module to be imported, make this logger a child of the main file's logger
+logger = logging.getLogger('__main__.'+__name__)
+
+
+class Annunciator:
+    '''Plays queued patterns on a buzzer (like gpiozero.TonalBuzzer) and an RGB LED (like gpiozero.RGBLED).
+A pattern is a list of steps (buzzer value, LED color, duration in seconds),
+where the buzzer value None is silent, and the LED color None leaves the LED as it is.
+
+Patterns are played in order of their priority, and in order of submission within the same priority.
+A pattern with a higher priority than the playing one interrupts it at once.
+The interrupted pattern is dropped, unless it repeats, in which case it is started over afterwards.
+Repeating patterns play until they are cancelled.'''
+    # priorities of the standard patterns
+    READOUT = 0
+    STATE = 1
+
+    def __init__(self, buzzer, led, beep_period=0.4):
+        self.buzzer = buzzer
+        self.led = led
+        self.beep_period = beep_period
+        self.queue = []  # heap of (-priority, sequence number, name, steps, repeat)
+        self.sequence = itertools.count()
+        self.playing = None  # the queue entry being played
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='annunciator', daemon=True)
+        self.thread.start()
+
+    def play(self, name, steps, priority=STATE, repeat=False):
+        '''Queue a pattern, and return immediately.'''
+        with self.condition:
+            heapq.heappush(self.queue, (-priority, next(self.sequence), name, steps, repeat))
+            self.condition.notify()
+
+    def cancel(self, name=None):
+        '''Stop and remove the patterns with the given name, or all patterns if name is None.'''
+        with self.condition:
+            self.queue = [entry for entry in self.queue if name is not None and entry[2] != name]
+            heapq.heapify(self.queue)
+            if self.playing and (name is None or self.playing[2] == name):
+                self.playing = None
+            self.condition.notify()
+
+    def close(self, timeout=None):
+        '''Play the queued patterns that don't repeat, and stop the thread (waiting at most timeout seconds).'''
+        with self.condition:
+            self.queue = [entry for entry in self.queue if not entry[4]]
+            heapq.heapify(self.queue)
+            if self.playing and self.playing[4]:
+                self.playing = None
+            self.closing = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+    def _output(self, name, value, color=None):
+        '''Set the buzzer value and LED color of a step, logging the errors instead of ending the thread.
+        Both are set separately, so the LED still shows the pattern when the buzzer fails, and the other way around.
+        '''
+        try:
+            self.buzzer.value = value
+        except Exception:
+            logger.exception('Playing {} on the buzzer failed'.format(name))
+        if color is not None:
+            try:
+                self.led.color = color
+            except Exception:
+                logger.exception('Playing {} on the LED failed'.format(name))
+
+    def _interrupted(self, entry):
+        '''Return whether the playing entry was cancelled or preempted, called with the condition held.'''
+        return self.playing is not entry or (self.queue and self.queue[0][0] < entry[0])
+
+    def run(self):
+        '''Play the queued patterns until closed.'''
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                entry = self.playing = heapq.heappop(self.queue)
+            for value, color, duration in entry[3]:
+                with self.condition:
+                    # checked under the lock that cancel takes, so no step of a cancelled pattern is played
+                    if self._interrupted(entry):
+                        break
+                    self._output(entry[2], value, color)
+                    self.condition.wait_for(lambda: self._interrupted(entry), duration)
+            self._output(entry[2], None)
+            with self.condition:
+                if entry[4] and self.playing is entry:
+                    # repeating patterns go back into the queue, also when preempted
+                    heapq.heappush(self.queue, (entry[0], next(self.sequence), *entry[2:]))
+                if self.playing is entry:
+                    self.playing = None
+
+    def beeps(self, on_time, off_time, n, on_color=None, off_color=None):
+        '''Return the steps of n beeps, with the LED switched to on_color and off_color along with the buzzer
+        (None leaves it as it is).
+        '''
+        return [(0, on_color, on_time), (None, off_color, off_time)]*n
+
+    def progress(self):
+        '''Beep the pattern for making progress in the statemachine.'''
+        self.play('progress', self.beeps(self.beep_period/2, self.beep_period/2, 2))
+
+    def setback(self):
+        '''Beep the pattern for a setback in the statemachine.'''
+        self.play('setback', self.beeps(3*self.beep_period/2, self.beep_period/2, 1))
+
+    def beep_out(self, num, dot=0.3, dash=0.6, pause=5, repeat=True, color=None):
+        '''Beep a given number in binary morse. 1 is 1 'dot' seconds, 0 is dash 'dash' time, separated by 1 'dot' silence.
+        The pause between repeats is 'pause' seconds silence.
+        With a color, the LED flashes the digits in that color along with the buzzer, and is off in between,
+        so the number can also be read out where the buzzer can't be heard.
+        '''
+        off_color = None if color is None else (0, 0, 0)
+        steps = []
+        for b in bin(num)[2:]:
+            steps += self.beeps(dot*int(b) + dash*(1-int(b)), dot, 1, color, off_color)
+        steps.append((None, off_color, pause))
+        self.play('readout', steps, self.READOUT, repeat)
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+'''Benchmarks of the flight software that run on a dev box,
+using the dummy stand-ins for the missing hardware.
+
+Run from the flight folder with `python3 bench.py`.
+'''
+
+import io
+import csv
+import time
+import random
+import altimu10v5
+import dummy
+import flightdata
+
+
+def compare_reads(n=200, clock_speed=400000):
+    '''Compare the per-byte and block read paths of all sensor outputs on a dummy SMBus.
+    Check that both return the same values, and print the time and transactions per read of each path.
+    '''
+    bus = dummy.SMBus(msb_auto_increment=(altimu10v5.LIS3MDL.ADDR, altimu10v5.LPS25H.ADDR),
+                      clock_speed=clock_speed)
+    imu = altimu10v5.IMU(bus=bus)
+    imu.enable()
+    reads = {'baro': imu.lps25h.get_barometer_raw,
+             'acc':  imu.lsm6ds33.get_accelerometer_raw,
+             'gyro': imu.lsm6ds33.get_gyroscope_raw,
+             'mag':  imu.lis3mdl.get_magnetometer_raw,
+             # status-gated reads, which return None (randomly, on the dummy bus) if there is no new data
+             'baro new': imu.lps25h.get_barometer_new,
+             'acc new':  imu.lsm6ds33.get_accelerometer_new,
+             'gyro new': imu.lsm6ds33.get_gyroscope_new,
+             'mag new':  imu.lis3mdl.get_magnetometer_new}
+    drivers = [imu.lsm6ds33, imu.lis3mdl, imu.lps25h]
+
+    for name, read in reads.items():
+        # flag new data in all status registers for the timing runs
+        for driver in drivers:
+            bus.registers[driver.ADDR][driver.STATUS_REG] = 0xff
+        timings = {}
+        for block_reads in (False, True):
+            for driver in drivers:
+                driver.block_reads = block_reads
+            transactions = bus.transactions
+            start = time.perf_counter()
+            for i in range(n):
+                read()
+            timings[block_reads] = ((time.perf_counter()-start)/n, (bus.transactions-transactions)/n)
+
+        for i in range(n):
+            bus.randomize()
+            for driver in drivers:
+                driver.block_reads = False
+            per_byte = read()
+            for driver in drivers:
+                driver.block_reads = True
+            assert per_byte == read(), '{}: per-byte and block reads differ'.format(name)
+
+        print('{:8}: per-byte {:8.1f} us ({:.0f} transactions), block {:8.1f} us ({:.0f} transactions)'\
+              .format(name, timings[False][0]*1e6, timings[False][1], timings[True][0]*1e6, timings[True][1]))
+
+
+def compare_formats(seconds=10, rate=208, chunk=1):
+    '''Compare the size and write time of the data formats, for IMU rows (timestamp, gyro xyz, acc xyz)
+    of a random walk at rate Hz, written in chunks of chunk seconds like the sensor saves.
+    '''
+    rows, timestamp, values = [], 10**12, [0]*6
+    for i in range(seconds*rate):
+        timestamp += round(1e9/rate)
+        values = [max(-2**15, min(2**15-1, value+random.randint(-20, 20))) for value in values]
+        rows.append([timestamp, *values])
+    layout = (['timestamp', 'gyro_x', 'gyro_y', 'gyro_z', 'acc_x', 'acc_y', 'acc_z'], '<qhhhhhh')
+    writers = {'csv': lambda f: csv.writer(f),
+               'binary': lambda f: flightdata.RecordWriter(f, 'imu', *layout),
+               'zlib': lambda f: flightdata.ChunkWriter(f, 'imu', *layout, compression='zlib'),
+               'zlib 1': lambda f: flightdata.ChunkWriter(f, 'imu', *layout, compression='zlib', level=1),
+               'lzma': lambda f: flightdata.ChunkWriter(f, 'imu', *layout, compression='lzma')}
+    for name, make_writer in writers.items():
+        f = io.StringIO() if name == 'csv' else io.BytesIO()
+        writer = make_writer(f)
+        start = time.perf_counter()
+        for i in range(0, len(rows), chunk*rate):
+            writer.writerows(rows[i:i+chunk*rate])
+        duration = time.perf_counter()-start
+        size = len(f.getvalue().encode() if name == 'csv' else f.getvalue())
+        print('{:8}: {:8} bytes, {:6.1f} ms per second of data'.format(name, size, 1000*duration/seconds))
+
+
+if __name__ == '__main__':
+    compare_reads()
+    compare_formats()
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+
+'''
+Shared timebase of the flight software.
+
+Timestamps are integer nanoseconds of the monotonic clock (time.monotonic_ns), which can't jump
+when the Pi gets its time over the network mid-session, are cheaper to take than float wall times,
+and fit in 8 bytes in the data files. One wall-clock anchor per session relates them to the wall time,
+so the ground software can rebase them (see to_wall).
+'''
+
+import os
+import time
+import logging
+
+NS = 1000000000  # nanoseconds per second
+
+now = time.monotonic_ns
+
+# taken back to back once per session, so the anchor is off by at most the time between the two calls
+anchor = {'wall_ns': time.time_ns(), 'monotonic_ns': time.monotonic_ns()}
+
+
+def to_wall(timestamp):
+    '''Return the wall time in seconds since the epoch of a timestamp, using the session anchor.'''
+    return (timestamp - anchor['monotonic_ns'] + anchor['wall_ns'])/NS
+
+
+def process_start():
+    '''Return the timestamp of the start of this process, with the resolution of the kernel clock ticks (10 ms),
+    or None where it is not available (without /proc).
+    '''
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the parenthesized command name, starting at the state (field 3)
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])  # starttime (field 22), in clock ticks since boot
+        age = time.clock_gettime_ns(time.CLOCK_BOOTTIME) - ticks*NS//os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+    return now() - age
+
+
+_default_record_factory = logging.getLogRecordFactory()
+
+
+def log_record_factory(*args, **kwargs):
+    '''Create log records with the creation time taken from the monotonic clock,
+    converted to wall time with the session anchor, so %(created)s stays comparable with the sensor timestamps.
+    Install with logging.setLogRecordFactory.
+    '''
+    record = _default_record_factory(*args, **kwargs)
+    record.created = to_wall(now())
+    record.msecs = int(record.created*1000) % 1000
+    return record
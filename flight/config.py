@@ -1,14 +1,172 @@
 #!/usr/bin/python3
 
 '''
-To make the importing of configuration variables cleaner than adding them to globals() directly
+To make the importing of configuration variables cleaner than adding them to globals() directly.
+The configuration is validated once when loading, and frozen afterwards,
+with the constants derived from it precomputed, so the hot paths only look them up.
 '''
 
+import os
 import json
+import types
+
+number = (int, float)
+color = list  # RGB values from 0 to 1
+pair = list  # [low, high], or two values
+
+
+def freeze(value):
+    '''Return a read-only copy of a JSON value: lists become tuples, and dicts read-only mappings.'''
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    '''Return a mutable copy of a value returned by freeze, as it was loaded from JSON.'''
+    if isinstance(value, types.MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
 
 class Config:
-    '''Provides the variables from a given JSON file as attributes, for cleaner namespace'''
-    def __init__(self, conf_file):
-        # get config variables from conf_file into local namespace
-        with open(conf_file) as f:
-            self.__dict__.update(json.load(f))
+    '''Provides the variables from a given JSON file as attributes, for cleaner namespace.
+The values are checked against KEYS when loading, and can't be changed afterwards (use replace for a changed copy),
+also not the nested ones: lists are stored as tuples, and dicts as read-only mappings (see freeze).
+Derived constants are precomputed:
+- baro_exponent: the exponent -R*a/g0 of the barometric formula
+- altitude_scale: the altitude factor T0/a of the barometric formula
+- pressure_smoothing: the factor of the exponential smoothing of the pressure, p_smoothing,
+  or 1 (no smoothing) with the FIFO mean mode, where the barometer already averages the samples
+- statemachine_intervals: the polling interval of the state machine per state
+- intervals(interval): the read intervals per state of a sensor with the given base interval'''
+    # the keys of the JSON file, with the types (or tuples of types) their values must have
+    KEYS = {'name': str,
+            'hatch_closed': number, 'hatch_open': number,
+            'hatch_pin': (int, type(None)), 'buzzer_pin': (int, type(None)), 'status_LED_pins': list,
+            'arm_switch_pin': (int, type(None)), 'breakwire_pin': (int, type(None)),
+            'beep_period': number, 'beep_frequency': number, 'blink_period': number,
+            'red': color, 'green': color, 'blue': color, 'white': color,
+            'yellow': color, 'magenta': color, 'cyan': color,
+            'sensor_intervals': dict,
+            'imu_fifo': bool, 'baro_fifo': (str, type(None)), 'baro_fifo_mean_samples': int,
+            'baro_averaging': pair, 'fifo_interval': number, 'pretrigger_time': number,
+            'acquisition': str, 'data_format': str, 'compression': str, 'compression_level': (int, type(None)),
+            'recorder_index_interval': number,
+            'fsync_policy': str, 'fsync_interval': number, 'writer_backlog': int, 'telemetry_interval': number,
+            'log_queue_size': int, 'log_preformat': bool,
+            'profiling': bool, 'profile_sample_every': int, 'profile_capacity': int,
+            'calibration_tolerance': dict, 'calibration_timeout': number, 'calibration_cache': (str, type(None)),
+            'calibration_max_age': number, 'calibration_max_temperature_delta': (number, type(None)),
+            'statemachine_interval': number, 'state_interval_factors': dict,
+            'deploy_window': pair, 'deploy_altitude': number, 'deploy_velocity': number,
+            'landing_window': pair, 'landing_altitude_range': pair, 'landing_velocity_range': pair,
+            'landed_logging_time': number,
+            'g0': number, 'T0': number, 'R': number, 'a': number,
+            'p_smoothing': number, 'v_smoothing': number,
+            'testing': bool, 'plot': bool}
+    # the allowed values of the keys with a fixed set of choices
+    CHOICES = {'baro_fifo': (None, 'mean', 'stream'),
+               'acquisition': ('scheduler', 'threads', 'process'),
+               'data_format': ('csv', 'binary', 'compressed', 'recorder'),
+               'compression': ('zlib', 'lzma'),
+               'fsync_policy': ('flush', 'interval', 'transition')}
+    STATES = ('IDLE', 'PREPARED', 'ARMED', 'LAUNCHED', 'DEPLOYED', 'LANDED')
+    # the keys of the nested dicts
+    SENSORS = ('baro', 'acc', 'gyro', 'mag')
+    CALIBRATED = ('gyro', 'baro')
+    DERIVED = ('baro_exponent', 'altitude_scale', 'pressure_smoothing', 'statemachine_intervals')
+
+    __slots__ = tuple(KEYS) + DERIVED + ('filename', 'mtime')
+
+    def __init__(self, conf_file, values=None, mtime=None):
+        # get config variables from conf_file (or the given dict) into the attributes
+        if values is None:
+            mtime = os.path.getmtime(conf_file)
+            with open(conf_file) as f:
+                values = json.load(f)
+        self.validate(values)
+        for name, value in values.items():
+            object.__setattr__(self, name, freeze(value))
+        object.__setattr__(self, 'filename', conf_file)
+        object.__setattr__(self, 'mtime', mtime)
+
+        object.__setattr__(self, 'baro_exponent', -self.R*self.a/self.g0)
+        object.__setattr__(self, 'altitude_scale', self.T0/self.a)
+        # smoothing the hardware moving average again would only add to its lag
+        object.__setattr__(self, 'pressure_smoothing', 1 if self.baro_fifo == 'mean' else self.p_smoothing)
+        object.__setattr__(self, 'statemachine_intervals', freeze(self.intervals(self.statemachine_interval)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('the configuration is frozen, use replace to change {}'.format(name))
+
+    def validate(self, values):
+        '''Raise a ValueError describing the first problem with the values of a configuration.'''
+        missing = [key for key in self.KEYS if key not in values]
+        unknown = [key for key in values if key not in self.KEYS]
+        if missing or unknown:
+            raise ValueError('configuration keys missing: {}, unknown: {}'.format(missing, unknown))
+        for key, expected in self.KEYS.items():
+            value = values[key]
+            # bool is a subclass of int, so true and false are only taken where a bool is expected
+            if not isinstance(value, expected) \
+               or isinstance(value, bool) and bool not in (expected if isinstance(expected, tuple) else (expected,)):
+                raise ValueError('configuration key {} has the wrong type: {!r}'.format(key, value))
+        for key, choices in self.CHOICES.items():
+            if values[key] not in choices:
+                raise ValueError('configuration key {} must be one of {}, not {!r}'.format(key, choices, values[key]))
+        for key, names in (('state_interval_factors', self.STATES), ('sensor_intervals', self.SENSORS),
+                           ('calibration_tolerance', self.CALIBRATED)):
+            if set(values[key]) != set(names):
+                raise ValueError('configuration key {} needs exactly the keys {}, not {}'
+                                 .format(key, names, list(values[key])))
+        positive = [values['statemachine_interval'], values['fifo_interval'], values['recorder_index_interval'],
+                    *values['sensor_intervals'].values(), *values['state_interval_factors'].values(),
+                    *values['calibration_tolerance'].values()]
+        if not all(isinstance(value, number) and not isinstance(value, bool) and value > 0 for value in positive):
+            raise ValueError('the intervals, interval factors and calibration tolerances must be positive numbers')
+        for key in ('deploy_window', 'landing_window', 'landing_altitude_range', 'landing_velocity_range'):
+            if len(values[key]) != 2 or not values[key][0] <= values[key][1]:
+                raise ValueError('configuration key {} must be a pair [low, high], not {!r}'.format(key, values[key]))
+        if values['pretrigger_time'] < 0:
+            raise ValueError('pretrigger_time must not be negative')
+        if values['a'] == 0 or values['g0'] == 0:
+            raise ValueError('the temperature lapse rate a and gravity g0 must not be zero')
+
+    def intervals(self, interval):
+        '''Return a dict with the intervals per state for the given base interval.'''
+        return {state: interval*factor for state, factor in self.state_interval_factors.items()}
+
+    def values(self):
+        '''Return a dict of the configuration values (without the derived constants), as a mutable copy
+        with the same types as loaded from the JSON file.
+        '''
+        return {key: thaw(getattr(self, key)) for key in self.KEYS}
+
+    def replace(self, **changes):
+        '''Return a copy of the configuration with some values changed, validated like a loaded one.'''
+        return Config(self.filename, dict(self.values(), **changes), self.mtime)
+
+    def reload(self):
+        '''Return the configuration loaded again from its file if the file changed since, otherwise this one.
+        If the changed file is invalid, the error is raised once, and this one is returned until it changes again.
+        '''
+        if not self.changed():
+            return self
+        mtime = os.path.getmtime(self.filename)
+        try:
+            return Config(self.filename)
+        except ValueError:
+            object.__setattr__(self, 'mtime', mtime)
+            raise
+
+    def changed(self):
+        '''Return whether the file was modified since this configuration was loaded from it.'''
+        try:
+            return self.mtime is not None and os.path.getmtime(self.filename) != self.mtime
+        except OSError:
+            return False
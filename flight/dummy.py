@@ -5,6 +5,7 @@ which then log any calls to that object.'''
 
 import random
 import ast
+import time
 import logging
 
 # because this is a module to be imported, make this logger a child of the main file's logger
@@ -69,6 +70,56 @@ informing about the call and its arguments.'''
         return method
 
 
+class SMBus:
+    '''Dummy object to replace the smbus.SMBus I2C bus, to run the sensor drivers on a dev box.
+It keeps a register map per device address, which is filled with random bytes by randomize(),
+so the per-byte and block read paths of the drivers can be compared for equivalence.
+Block reads auto increment the register address, except for the devices in msb_auto_increment,
+which (like the LPS25H and LIS3MDL) only do so if the MSB of the register address is set.
+If clock_speed is given, every transaction sleeps for the time it would take on the bus,
+so the read paths can also be compared for speed.'''
+    def __init__(self, bus_id=1, msb_auto_increment=(), clock_speed=None):
+        self.bus_id = bus_id
+        self.msb_auto_increment = msb_auto_increment
+        self.clock_speed = clock_speed
+        self.registers = {}  # {address: bytearray of 256 registers}
+        self.transactions = 0
+
+    def _device(self, address):
+        if address not in self.registers:
+            self.registers[address] = bytearray(256)
+        return self.registers[address]
+
+    def _transfer(self, n_bytes):
+        '''Count the transaction, and sleep for the time that n_bytes data bytes would take on the bus.
+        Every transaction additionally transfers the address and register bytes, and the read address.'''
+        self.transactions += 1
+        if self.clock_speed:
+            time.sleep((3+n_bytes)*9/self.clock_speed)
+
+    def randomize(self, address=None):
+        '''Fill the registers of one or all devices with random bytes.'''
+        for addr in ([address] if address is not None else self.registers):
+            self._device(addr)[:] = bytes(random.getrandbits(8) for i in range(256))
+
+    def read_byte_data(self, address, register):
+        self._transfer(1)
+        return self._device(address)[register & 0x7f if address in self.msb_auto_increment else register]
+
+    def write_byte_data(self, address, register, value):
+        self._transfer(1)
+        self._device(address)[register] = value
+
+    def read_i2c_block_data(self, address, register, length=32):
+        self._transfer(length)
+        device = self._device(address)
+        if address in self.msb_auto_increment:
+            if not register & 0x80:
+                return [device[register]]*length
+            register &= 0x7f
+        return list(device[register:register+length])
+
+
 #class Profiler:
 #    '''Dummy object to replace profiler and its function decorators in case we don't need it.'''
 #    def __init__(self):
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+'''
+Compact binary format for the flight data, as an alternative to the csv files.
+
+Every file starts with a self-describing header, followed by fixed-size little endian records:
+- the 8 byte magic MAGIC
+- the length of the JSON header as unsigned 32 bit integer
+- the JSON header, padded with spaces to a multiple of 8 bytes (counting from the start of the file),
+  with the sensor name, column names, struct format of one record, and the metadata
+  (register settings, and scale factors and offsets per column to convert to physical units)
+- the records, one per row, as packed by struct with the format in the header
+
+In compressed files (written by ChunkWriter, with 'compression' in the header), the records are replaced by chunks
+of the rows of one write, which can be decompressed independently of each other:
+- the chunk header CHUNK: the magic CHUNK_MAGIC, the number of rows, and the length of the compressed payload
+- the payload, compressed with zlib or lzma: the columns one after another, as little endian arrays of the
+  types in the record format, where the integer columns (marked in 'delta' in the header) are delta encoded:
+  every value is stored as the difference to the previous row (the first one to 0), wrapped to the column type
+
+The ground software reads the records without parsing, see ground/flightdata.py.
+'''
+
+import sys
+import json
+import lzma
+import zlib
+import struct
+from array import array
+
+MAGIC = b'SRPDATA1'
+CHUNK_MAGIC = b'SRPC'
+CHUNK = struct.Struct('<4sII')  # magic, number of rows, length of the payload
+INTEGER_TYPECODES = 'bBhHiIqQ'
+
+
+def encode_header(name, columns, fmt, metadata=None):
+    '''Return the header bytes for a file with the given sensor name, column names, record format and metadata.'''
+    header = json.dumps({'name': name, 'columns': columns, 'format': fmt, **(metadata or {})}).encode()
+    padding = -(len(MAGIC)+4+len(header)) % 8
+    return MAGIC + struct.pack('<I', len(header)+padding) + header + b' '*padding
+
+
+class RecordWriter:
+    '''Writes rows as fixed-size binary records to an opened binary file, like a csv.writer.
+The header is written first, unless the file already contains data (when appending).'''
+    def __init__(self, file, name, columns, fmt, metadata=None):
+        self.file = file
+        self.struct = struct.Struct(fmt)
+        if file.tell() == 0:
+            file.write(encode_header(name, columns, fmt, metadata))
+
+    def writerows(self, rows):
+        '''Pack and write the rows.'''
+        pack = self.struct.pack
+        self.file.write(b''.join([pack(*row) for row in rows]))
+
+
+def delta_encode(values, typecode):
+    '''Return the differences between consecutive integer values (the first one to 0),
+    wrapped around to the range of the typecode, so they fit in the same type, and the cumulative sum restores them.
+    '''
+    bits = 8*array(typecode).itemsize
+    mask = (1<<bits)-1
+    if typecode.isupper():
+        return [(value-previous) & mask for previous, value in zip([0]+values, values)]
+    half = 1<<(bits-1)
+    return [((value-previous+half) & mask)-half for previous, value in zip([0]+values, values)]
+
+
+def compressor(compression, level=None):
+    '''Return the compression function for 'zlib' or 'lzma', at the given level (or preset),
+    or the default of the compressor if it is None.
+    '''
+    if compression == 'zlib':
+        return lambda data: zlib.compress(data, -1 if level is None else level)
+    if compression == 'lzma':
+        return lambda data: lzma.compress(data, preset=level)
+    raise ValueError('Unknown compression {}, choose from zlib, lzma'.format(compression))
+
+
+def encode_columns(rows, typecodes, delta):
+    '''Return the rows as the columns one after another, as little endian arrays of the typecodes,
+    with the columns marked in delta delta encoded.
+    '''
+    parts = []
+    for values, typecode, encode in zip(zip(*rows), typecodes, delta):
+        column = array(typecode, delta_encode(list(values), typecode) if encode else values)
+        if sys.byteorder == 'big':
+            column.byteswap()
+        parts.append(column.tobytes())
+    return b''.join(parts)
+
+
+class ChunkWriter:
+    '''Writes rows as delta encoded and compressed chunks to an opened binary file, like RecordWriter,
+one chunk per call of writerows. compression is 'zlib' or 'lzma', at the given level (or preset),
+or the default of the compressor if it is None.
+The header is written first, unless the file already contains data (when appending).'''
+    def __init__(self, file, name, columns, fmt, metadata=None, compression='zlib', level=None):
+        self.file = file
+        self.typecodes = fmt.lstrip('<')
+        self.delta = [typecode in INTEGER_TYPECODES for typecode in self.typecodes]
+        self.compress = compressor(compression, level)
+        if file.tell() == 0:
+            file.write(encode_header(name, columns, fmt,
+                                     dict(metadata or {}, compression=compression, delta=self.delta)))
+
+    def encode(self, rows):
+        '''Return the chunk of the rows, with its header.'''
+        payload = self.compress(encode_columns(rows, self.typecodes, self.delta))
+        return CHUNK.pack(CHUNK_MAGIC, len(rows), len(payload)) + payload
+
+    def writerows(self, rows):
+        '''Encode and write the rows as one chunk.'''
+        if rows:
+            self.file.write(self.encode(rows))
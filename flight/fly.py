@@ -7,45 +7,68 @@ Logs data and actuates deployment of the SRP Reimagined rocket
 
 ########################################
 # imports
+import time
+# (phase, monotonic_ns at its end) for the startup timing breakdown, logged when entering IDLE
+startup = [('interpreter', time.monotonic_ns())]
 import os
 # set working directory to the location of this script for the sensor module imports to work
 workdir = '/'.join(os.path.realpath(__file__).split('/')[:-1])+'/'  # only meant for unix-type file systems
 os.chdir(workdir)
 import sys
 import shutil
-import time
 import math
 import csv
 import logging
 import threading
-import subprocess
+import functools
+import collections
 import altimu10v5
 import dummy
+import clock
+import flightdata
+from recorder import Recorder
+import sharedmem
+from ringbuffer import RingBuffer
 from config import Config
+from scheduler import Scheduler
+from telemetry import LoopStats, Telemetry
+from writer import Writer
+from annunciator import Annunciator
+from logqueue import LogQueue
 # use different pin_factory for the servo to prevent jittering
 # requires 'sudo pigpio' to be run before this script
 from gpiozero.pins.pigpio import PiGPIOFactory
 import gpiozero
 
 import pyprofile
-pf = pyprofile.Profiler()
+startup.append(('imports', time.monotonic_ns()))
 
 ########################################
 # definitions
 
 # state variables
+states = ['OFF', 'IDLE', 'PREPARED', 'ARMED', 'LAUNCHED', 'DEPLOYED', 'LANDED']  # numbered for the shared control block
 state = 'IDLE'
 last_state = 'OFF'
+# barometer estimate, only updated by the baro sensor (in the acquisition process, if it is separate)
 p = [0, 0]  # last two pressure values
 h = [0, 0]  # last two altitude values
 v = [0, 0]  # last two velocity values
 # reference variables
 p0 = None
 flight_start = None
+landing_time = None
 apogee = 0
+# the estimate as the state machine sees it: a consistent snapshot of one update,
+# and the deployment and landing conditions on it, evaluated once per snapshot
+Estimate = collections.namedtuple('Estimate', ['count', 'timestamp', 'p', 'h', 'v', 'apogee'])
+snapshot = Estimate(0, 0, 0, 0, 0, 0)
+conditions = (False, False)
 
 conf = Config('config.json')
 
+pf = pyprofile.Profiler(clock.now, conf.profile_capacity, conf.profile_sample_every, conf.profiling)
+
 ########################################
 # state machine functions
 
@@ -55,10 +78,14 @@ def update_statemachine():
     Change the state depending on conditions given in state diagram.
     Also execute any actions when transitioning between states.
     '''
-    global state, last_state, flight_start  # making a State class could make this neater
-    t = time.time()  # eliminates the many calls to time.time() whenever it is used
+    global state, last_state, flight_start, landing_time  # making a State class could make this neater
+    t = clock.now()  # eliminates the many calls to clock.now() whenever it is used
+    deploy_condition, landing_condition = evaluate_estimate()
 
     if state == 'IDLE':
+        if last_state == 'OFF':
+            startup.append(('IDLE', time.monotonic_ns()))
+            log_startup()
         if last_state != state:
             hatch.value = conf.hatch_closed
             status_LED.color = conf.green
@@ -67,7 +94,7 @@ def update_statemachine():
         # TODO: solve this in a nicer way if possible, maybe by warning if arm_switch is on in IDLE
         if breakwire.value and not arm_switch.value:
             # put stuff to be executed on changing from IDLE to PREPARED here
-            buzzer.progress()
+            annunciator.progress()
             state = 'PREPARED'
 
     elif state == 'PREPARED':
@@ -75,10 +102,10 @@ def update_statemachine():
             status_LED.color = conf.blue
             last_state = state
         if not breakwire.value:
-            buzzer.setback()
+            annunciator.setback()
             state = 'IDLE'
         elif arm_switch.value:
-            buzzer.progress()
+            annunciator.progress()
             state = 'ARMED'
 
     elif state == 'ARMED':
@@ -86,23 +113,32 @@ def update_statemachine():
             last_state = state
             if not imu.enabled:
                 status_LED.default_blink(on_color=conf.blue)
+                setup_acquisition()
                 imu.enable()
-                imu.calibrate()
+                imu.lps25h.set_averaging(*conf.baro_averaging)
+                calibration = imu.calibrate(conf.calibration_tolerance['gyro'], conf.calibration_tolerance['baro'],
+                                            conf.calibration_timeout, conf.calibration_cache,
+                                            conf.calibration_max_age, conf.calibration_max_temperature_delta)
+                logger.debug('Calibration: {gyro_samples} gyro samples, {baro_samples} pressure samples, '
+                             'gyro offsets {gyro_cal}, p0 {p0:.1f} Pa at {temperature:.1f} degrees'.format(**calibration))
                 global p0, p
-                p0s = []
-                for i in range(50):
-                    p0s.append(imu.lps25h.get_barometer_raw()/40.96)
-                p0 = sum(p0s)/len(p0s)
+                p0 = calibration['p0']
                 p = [p0]*2
-                logger.debug('Sensor calibration finished, starting threads now')
-                for sensor in sensors:
-                    sensor.start_thread()
+                # the FIFO mean mode is enabled after the calibration, as it correlates the samples
+                if conf.baro_fifo == 'mean':
+                    imu.lps25h.enable_fifo_mean(conf.baro_fifo_mean_samples)
+                if conf.imu_fifo:
+                    imu.lsm6ds33.enable_fifo()
+                if conf.baro_fifo == 'stream':
+                    imu.lps25h.enable_fifo_stream()
+                logger.debug('Sensor calibration finished, starting acquisition now')
+                start_acquisition()
             status_LED.color = conf.red
         if not arm_switch.value:
-            buzzer.setback()
+            annunciator.setback()
             state = 'PREPARED'
         elif not breakwire.value:
-            buzzer.progress()
+            annunciator.progress()
             state = 'LAUNCHED'
 
     elif state == 'LAUNCHED':
@@ -110,51 +146,38 @@ def update_statemachine():
             status_LED.default_blink(on_color=conf.red, off_color=conf.green)
             last_state = state
             flight_start = t
-        if ((t > flight_start+conf.deploy_window[0])\
-            and (h[1]<conf.deploy_altitude and v[1]<conf.deploy_velocity))\
-           or (t > flight_start+conf.deploy_window[1]):
+        if ((t > flight_start+conf.deploy_window[0]*clock.NS) and deploy_condition)\
+           or (t > flight_start+conf.deploy_window[1]*clock.NS):
             hatch.value = conf.hatch_open
-            buzzer.progress()
+            annunciator.progress()
             state = 'DEPLOYED'
 
     elif state == 'DEPLOYED':
         if last_state != state:
             status_LED.default_blink(on_color=conf.red, off_color=conf.blue)
             last_state = state
-        if ((t > flight_start+conf.landing_window[0])\
-            and (conf.landing_altitude_range[0]<h[1]<conf.landing_altitude_range[1]\
-                 and conf.landing_velocity_range[0]<v[1]<conf.landing_velocity_range[1]))\
-           or (t > flight_start+conf.landing_window[1]):
-            buzzer.progress()
+        if ((t > flight_start+conf.landing_window[0]*clock.NS) and landing_condition)\
+           or (t > flight_start+conf.landing_window[1]*clock.NS):
+            annunciator.progress()
             state = 'LANDED'
 
     elif state == 'LANDED':
         if last_state != state:
             status_LED.default_blink(on_color=conf.green, off_color=conf.blue)
-            # landing routine:
-            time.sleep(5)
-            stop.set()
-            for sensor in sensors:
-                try:
-                    sensor.save()
-                except (AttributeError, ValueError) as e:
-                    logger.warning('Saving the last data failed, because the csv file was not opened',
-                                   exc_info=False)
-            for sensor in sensors:
-                try:
-                    sensor.thread.join()
-                except AttributeError as e:
-                    logger.warning('Joining the sensor threads failed, because they were not created/started',
-                                   exc_info=False)
             last_state = state
+            landing_time = t
+        # landing routine: keep logging for landed_logging_time, then beep out the apogee until switched off
+        landed = t > landing_time+conf.landed_logging_time*clock.NS
+        if acquisition_workers and not stop.is_set() and (landed or not arm_switch.value):
+            stop_acquisition()
             status_LED.color = conf.white
+            annunciator.beep_out(int(snapshot.apogee), color=conf.white)
         if not arm_switch.value:
-            buzzer.progress()
+            annunciator.cancel('readout')
+            annunciator.progress()
             state = 'OFF'
             logger.info('{} to {}'.format(last_state, state))  # needs to be repeated here, because the function will return before reaching the end
             return 'stop'
-        else:
-            buzzer.beep_out(int(apogee))
 
     else:
         logger.warning('State variable is {}, matching no existing state. Going to do TBD now'.format(state))
@@ -162,6 +185,32 @@ def update_statemachine():
     if last_state != state:
         status_LED.off()
         logger.info('{} to {}'.format(last_state, state))
+        if control:
+            control.write(states.index(state))  # picked up by the acquisition process
+        elif writer:  # the acquisition is only set up when arming
+            update_sensors()
+            writer.sync()
+        wakeup.set()  # run the entry actions of the new state right away
+
+
+def time_to_next_check():
+    '''Return the seconds until the state machine needs to run without being woken up:
+    until the next edge of the deploy or landing window or the landed logging time, or else the polling interval of the state,
+    as fallback for inputs without callbacks (like the dummy inputs).
+    '''
+    timeout = conf.statemachine_intervals[state]
+    if flight_start is None:
+        return timeout
+    edges = {'LAUNCHED': [flight_start+edge*clock.NS for edge in conf.deploy_window],
+             'DEPLOYED': [flight_start+edge*clock.NS for edge in conf.landing_window],
+             'LANDED': [landing_time+conf.landed_logging_time*clock.NS] if landing_time else []}.get(state, [])
+    now = clock.now()
+    for edge in edges:
+        remaining = (edge - now)/clock.NS
+        if remaining > 0:
+            # the conditions compare with >, so wake up just after the edge
+            timeout = min(timeout, remaining+0.001)
+    return timeout
 
 
 ########################################
@@ -182,14 +231,6 @@ class BeepingTonalBuzzer(gpiozero.TonalBuzzer):
         if (not background) and n:
             time.sleep((on_time+off_time)*n)  # block for the time that it takes square_wave to finish the n beeps
 
-    def progress(self):
-        '''Beep the pattern for making progress in the statemachine.'''
-        self.beep(conf.beep_period/2, conf.beep_period/2, n=2, background=False)
-
-    def setback(self):
-        '''Beep the pattern for a setback in the statemachine.'''
-        self.beep(3*conf.beep_period/2, conf.beep_period/2, n=1, background=False)
-
     def beep_out(self, num, dot=0.3, dash=0.6, pause=5):
         '''Beep a given number in binary morse. 0 is 1 'dot' seconds, 1 is dash 'dash' time, separated by 1 'dot' silence. The pause between repeats is 'pause' seconds silence.'''
         pattern = [dot*int(b) + dash*(1-int(b)) for b in str(bin(num))[2:]]
@@ -217,81 +258,366 @@ class BeepingTonalBuzzer(gpiozero.TonalBuzzer):
 
 class Sensor:
     '''Provide functions for sensor readout and saving data.'''
-    def __init__(self, name, default_interval, func, save_interval=1):
+    def __init__(self, name, default_interval, func, save_interval=1, batched=False, sample_period=None,
+                 layout=(['timestamp', 'value'], '<qd'), metadata=None, scale=1):
         self.name = name
         # read-related
         self.default_interval = default_interval
+        # the interval is run slower when idling, it is set from this table on every state change
+        self.intervals = conf.intervals(default_interval)
+        if conf.pretrigger_time:
+            # the pre-trigger window is recorded at the full (LAUNCHED) rate
+            self.intervals['ARMED'] = self.intervals['LAUNCHED']
+        self.interval = self.intervals[state]
+        self.scale = scale  # physical units per raw unit, like Pa/LSB for the pressure estimate
         self.func = func
-        self.data = []
+        self.batched = batched  # whether func returns a list of already timestamped rows, like a FIFO drain
+        self.sample_period = sample_period  # seconds between the rows of a batched sensor
+        self.layout = layout  # (column names, struct format) of the rows, also used for the binary records
+        # hold two save intervals at the fastest (LAUNCHED) rate, so a late save does not lose any rows,
+        # and the pre-trigger window, which is only saved after leaving ARMED
+        fastest = sample_period or min(self.intervals.values())
+        capacity, typecodes = int((2*save_interval+conf.pretrigger_time)/fastest)+1, layout[1].lstrip('<')
+        # also in a separate acquisition process, the rows stay private to it, as the main process doesn't read them
+        self.data = RingBuffer(capacity, typecodes)
         # save-related
         self.save_interval = save_interval  # number of seconds to wait  between writing the newest data to a file
-        self.filename = datafilename + '_' + self.name + '.csv'
+        self.metadata = metadata  # function returning the metadata for the binary header, called when opening
+        self.offsets = None  # subtracted from the raw values in the csv files, like the gyro calibration
+        self.binary = conf.data_format != 'csv'
+        if conf.data_format == 'recorder':
+            self.filename = recorder.filename  # shared by all sensors
+        else:
+            self.filename = datafilename + '_' + self.name + ('.bin' if self.binary else '.csv')
         self.writer = None
-        self.last_idx = 0  # index of where the last saving operation left off
+        self.last_idx = 0  # running index of the ring buffer row where the last saving operation left off
+        self.holding = False  # whether rows are held back in the ring buffer for the pre-trigger window
+        self.state_change = clock.now()  # time of the last state change, set by update_sensors
+        self.stats = LoopStats()  # timing of the read loop, recorded by the scheduler or read_thread
 
-    @property
-    def interval(self):
-        '''Set the reading interval according to the current state,
-        as the idea is to run the entire rocket slower when idling.
-        '''
-        return self.default_interval*conf.state_interval_factors[state]
-        
     @pf.profile
     def read(self):
         '''Read and process data from the sensor.
         Return the time it took to run, for the calling loop to sleep for the rest of the interval.
         '''
-        start = time.time()
+        start = clock.now()
         values = self.func()
-        if isinstance(values, list):
-            # using the start time, to prevent calling time.time() unneccesarily,
+        if values is None or (self.batched and not values):
+            # no new conversion since the last read, so there is nothing to log
+            return (clock.now()-start)/clock.NS
+        if self.batched:
+            self.data.extend(values)
+        elif isinstance(values, list):
+            # using the start time, to prevent calling clock.now() unneccesarily,
             # and to log the same timestamp in both cases
-            self.data.append([start, *values])
+            self.data.append(start, values)
         else:
-            self.data.append([start, values])
+            self.data.append(start, (values,))
         # barometer only: update state variables
         if self.name == 'baro':
-            self.update_state_variables()
-        return time.time()-start
+            if self.batched:
+                for row in values:
+                    self.update_state_variables(row[0], row[1], self.sample_period)
+            else:
+                # status-gated reads skip stale samples, so the time step is taken from the timestamps
+                if len(self.data) > 1:
+                    dt = (self.data.get(-1, 0)-self.data.get(-2, 0))/clock.NS
+                else:
+                    dt = self.interval
+                self.update_state_variables(self.data.get(-1, 0), self.data.get(-1, 1), dt)
+            if state in ('LAUNCHED', 'DEPLOYED'):
+                # the deployment and landing conditions depend on the new estimate
+                wakeup.set()
+        return (clock.now()-start)/clock.NS
 
     @pf.profile
     def save(self):
-        '''Save the latest data, and return the time it took to run.'''
-        start = time.time()
-        self.writer.writerows(self.data[self.last_idx:])
-        self.last_idx = len(self.data)
+        '''Hand the latest data over to the background writer, and return the time it took to run.'''
+        start = clock.now()
+        telemetry.update(self, time.monotonic())
+        if conf.pretrigger_time and state == 'ARMED':
+            # nothing is written on the pad, the ring buffer keeps the newest rows
+            self.holding = True
+            return (clock.now()-start)/clock.NS
+        if self.holding:
+            # after ARMED, only the rows of the pre-trigger window before the state change are saved
+            self.holding = False
+            self.last_idx = max(self.last_idx, self.data.find(self.state_change-conf.pretrigger_time*clock.NS))
+        if self.last_idx == self.data.total:
+            return (clock.now()-start)/clock.NS
+        rows, lost = self.data.since(self.last_idx)
+        self.last_idx = self.data.total
+        if lost:
+            logger.warning('{} rows of {} were overwritten before saving'.format(lost, self.name))
+        writer.submit(self, rows)
+        return (clock.now()-start)/clock.NS
+
+    def write(self, rows):
+        '''Write rows to the file, called from the writer thread.'''
+        if self.offsets and not self.binary:
+            rows = [[value-offset for value, offset in zip(row, self.offsets)] for row in rows]
+        self.writer.writerows(rows)
         self.file.flush()
-        return time.time()-start
-        
+
+    def open(self):
+        '''Open the csv or binary file for appending, or the stream in the opened recorder file,
+        and return the file to be closed by the caller.
+        '''
+        metadata = self.metadata and self.metadata()
+        if self.binary:
+            # the anchor to convert the monotonic timestamps to wall time
+            metadata = dict(metadata or {}, clock=clock.anchor)
+        if metadata and any(metadata.get('offset', [])):
+            self.offsets = metadata['offset']
+        if conf.data_format == 'recorder':
+            self.file = recorder.file
+            self.writer = recorder.stream(self.name, *self.layout, metadata=metadata,
+                                          compression=conf.compression, level=conf.compression_level)
+        elif self.binary:
+            self.file = open(self.filename, 'ab')
+            if conf.data_format == 'compressed':
+                self.writer = flightdata.ChunkWriter(self.file, self.name, *self.layout, metadata=metadata,
+                                                     compression=conf.compression, level=conf.compression_level)
+            else:
+                self.writer = flightdata.RecordWriter(self.file, self.name, *self.layout, metadata=metadata)
+        else:
+            self.file = open(self.filename, 'a')
+            self.writer = csv.writer(self.file)
+        return self.file
+
     def read_thread(self):
         '''Run the data reading function repeatedly in the background,
         and run the data saving function at set intervals.
         '''
-        next_save = time.time() + self.save_interval
-        with open(self.filename, 'a') as self.file:
-            self.writer = csv.writer(self.file)
-            while not stop.is_set():
-                sleep_duration = self.interval - self.read()
-                if time.time() > next_save:
-                    sleep_duration -= self.save()
-                    next_save += self.save_interval
-                time.sleep(max(0, sleep_duration))
+        deadline = time.monotonic()
+        next_save = deadline + self.save_interval
+        while not stop.is_set():
+            start = time.monotonic()
+            interval = self.interval
+            duration = self.read()
+            if start > next_save:
+                duration += self.save()
+                next_save += self.save_interval
+            self.stats.record(start, duration, interval, max(0, start-deadline))
+            deadline = start+interval
+            time.sleep(max(0, interval-duration))
+        self.save()
 
     def start_thread(self):
         '''Set up the thread and start it.'''
-        self.thread = threading.Thread(target=self.read_thread)
+        self.thread = threading.Thread(target=self.read_thread, name=self.name)
         self.thread.start()
 
     @pf.profile
-    def update_state_variables(self):
-        '''Update the global state variables, which are used for deployment decisions.'''
-        global p, h, v
-        p = [p[1], conf.p_smoothing*(self.data[-1][1]/40.96) + (1-conf.p_smoothing)*p[0]]
-        h = [h[1], conf.T0/conf.a*((p[1]/p0)**(-conf.R*conf.a/conf.g0)-1)]
-        v = [v[1], conf.v_smoothing*(h[1]-h[0])/self.interval + (1-conf.v_smoothing)*v[0]]
+    def update_state_variables(self, timestamp, value, dt):
+        '''Update the global state variables, which are used for deployment decisions,
+        with a new raw pressure value taken at timestamp, dt seconds after the previous one,
+        and publish them as one snapshot for the state machine.
+        '''
+        global p, h, v, apogee
+        p_smoothing, v_smoothing, altitude_scale, baro_exponent = \
+            conf.pressure_smoothing, conf.v_smoothing, conf.altitude_scale, conf.baro_exponent
+        p = [p[1], p_smoothing*value*self.scale + (1-p_smoothing)*p[0]]
+        h = [h[1], altitude_scale*((p[1]/p0)**baro_exponent-1)]
+        v = [v[1], v_smoothing*(h[1]-h[0])/dt + (1-v_smoothing)*v[0]]
         if h[1] >= apogee:
-            global apogee
             apogee = h[1]
+        estimate.write(timestamp, p[1], h[1], v[1], apogee)
+
+
+def evaluate_estimate():
+    '''Return whether the deployment and the landing condition on the barometer estimate hold.
+    The estimate is read as one snapshot (see sharedmem.SharedValues, locked only between processes),
+    so the altitude and velocity are always of the same update, and only when a new one was published since.
+    '''
+    global snapshot, conditions
+    if estimate.count != snapshot.count:
+        count, values = estimate.read()
+        snapshot = Estimate(count, *values)
+        conditions = (snapshot.h < conf.deploy_altitude and snapshot.v < conf.deploy_velocity,
+                      conf.landing_altitude_range[0] < snapshot.h < conf.landing_altitude_range[1]
+                      and conf.landing_velocity_range[0] < snapshot.v < conf.landing_velocity_range[1])
+    return conditions
+
+
+def follow_shared_state():
+    '''Take over the state transitions of the main process in the acquisition process,
+    called by the scheduler every loop.
+    '''
+    global state
+    new_state = states[int(control.read()[1][0])]
+    if new_state != state:
+        state = new_state
+        update_sensors()
+        writer.sync()
+
+
+def update_sensors():
+    '''Set the read intervals of the sensors for the current state, looked up in their precomputed tables,
+    and the time of the state change, from which the pre-trigger window is saved after leaving ARMED.
+    '''
+    now = clock.now()
+    for sensor in sensors:
+        sensor.interval = sensor.intervals[state]
+        sensor.state_change = now
+
+
+def reload_config():
+    '''Take over the changes of the config file, used on the ground in testing mode to try settings without restarting.
+    It is only called before arming, so the acquisition is set up with the new settings,
+    while the pins, beep and profiler settings keep their values until the next start.
+    '''
+    global conf
+    try:
+        new_conf = conf.reload()
+    except ValueError as e:
+        logger.warning('Ignoring the changed config file: {}'.format(e))
+        return
+    if new_conf is not conf:
+        conf = new_conf
+        shutil.copyfile(conf.filename, datafilename+'_config.json')
+        logger.info('Reloaded the config file')
+
+
+def setup_acquisition():
+    '''Probe the sensors, and set up their ring buffers and the scheduler, writer and telemetry.
+    Called when arming for the first time, as nothing before ARMED needs them, which shortens the startup.
+    '''
+    global conf, sensors, scheduler, writer, telemetry, recorder
+    if conf.data_format == 'recorder':
+        # one file for the data of all sensors, with the session metadata in its header
+        recorder = Recorder(datafilename+'.rec', {'name': conf.name, 'clock': clock.anchor, 'config': conf.values()},
+                            conf.recorder_index_interval)
+    # automatic dummy assignment if the sensors are not present, to allow for easier testing
+    if sensors_present():
+        xyz = ['timestamp', 'x', 'y', 'z']
+        # the metadata is only requested when opening the files, after enabling and calibrating the sensors
+        baro_metadata = lambda: {'settings': imu.lps25h.settings,
+                                 'scale': [1, imu.lps25h.baro_scale]}
+        acc_metadata  = lambda: {'settings': imu.lsm6ds33.settings,
+                                 'scale': [1] + [imu.lsm6ds33.acc_scale]*3}
+        # the gyro is logged raw, the calibration is stored as offset in the binary header,
+        # and subtracted when saving to csv
+        gyro_metadata = lambda: {'settings': imu.lsm6ds33.settings,
+                                 'scale': [1] + [imu.lsm6ds33.gyro_scale]*3,
+                                 'offset': [0] + imu.lsm6ds33.gyro_cal}
+        mag_metadata  = lambda: {'settings': imu.lis3mdl.settings,
+                                 'scale': [1] + [imu.lis3mdl.mag_scale]*3}
+        imu_metadata  = lambda: {'settings': imu.lsm6ds33.settings,
+                                 'scale': [1] + [imu.lsm6ds33.gyro_scale]*3 + [imu.lsm6ds33.acc_scale]*3,
+                                 'offset': [0] + imu.lsm6ds33.gyro_cal + [0]*3}
+
+        # the status-gated reads return None if the sensor has no new data, which is then not logged
+        if conf.baro_fifo == 'stream':
+            # the stored pressure samples are drained every fifo_interval
+            baro = Sensor('baro', conf.fifo_interval, imu.lps25h.read_fifo, batched=True,
+                          sample_period=imu.lps25h.period, layout=(['timestamp', 'pressure'], '<qi'),
+                          metadata=baro_metadata, scale=imu.lps25h.baro_scale)
+        else:
+            baro = Sensor('baro', conf.sensor_intervals['baro'], imu.lps25h.get_barometer_new,
+                          layout=(['timestamp', 'pressure'], '<qi'), metadata=baro_metadata,
+                          scale=imu.lps25h.baro_scale)
+        mag  = Sensor('mag',  conf.sensor_intervals['mag'],  imu.lis3mdl.get_magnetometer_new,
+                      layout=(xyz, '<qhhh'), metadata=mag_metadata)
+        # only the sensors of the selected mode are made, as each one allocates its ring buffer
+        if conf.imu_fifo:
+            # in FIFO mode, the gyro and accelerometer samples are drained together into one file
+            imu_fifo = Sensor('imu', conf.fifo_interval,
+                              functools.partial(imu.lsm6ds33.read_fifo, calibrated=False), batched=True,
+                              sample_period=imu.lsm6ds33.period,
+                              layout=(['timestamp', 'gyro_x', 'gyro_y', 'gyro_z', 'acc_x', 'acc_y', 'acc_z'],
+                                      '<qhhhhhh'),
+                              metadata=imu_metadata)
+            sensors = [baro, imu_fifo, mag]
+        else:
+            acc  = Sensor('acc',  conf.sensor_intervals['acc'],  imu.lsm6ds33.get_accelerometer_new,
+                          layout=(xyz, '<qhhh'), metadata=acc_metadata)
+            gyro = Sensor('gyro', conf.sensor_intervals['gyro'],
+                          functools.partial(imu.lsm6ds33.get_gyroscope_new, calibrated=False),
+                          layout=(xyz, '<qhhh'), metadata=gyro_metadata)
+            sensors = [baro, acc, gyro, mag]
+    else:
+        logger.debug('AltIMU10v5 sensors not present, the logged data will be generated by a dummy function')
+        baro = Sensor('baro', conf.sensor_intervals['baro'], dummy.Sensor('baro').get,
+                      scale=altimu10v5.LPS25H.baro_scale)
+        acc  = Sensor('acc',  conf.sensor_intervals['acc'],  dummy.Sensor('acc').get)
+        gyro = Sensor('gyro', conf.sensor_intervals['gyro'], dummy.Sensor('gyro').get)
+        mag  = Sensor('mag',  conf.sensor_intervals['mag'],  dummy.Sensor('mag').get)
+        conf = conf.replace(imu_fifo=False, baro_fifo=None)  # the dummy functions can't emulate the FIFOs
+        sensors = [baro, acc, gyro, mag]
+    scheduler = Scheduler(sensors, stop, tick=follow_shared_state if control else None)
+    writer = Writer(conf.fsync_policy, conf.fsync_interval, conf.writer_backlog)
+    telemetry = Telemetry(datafilename+'_telemetry.csv', conf.telemetry_interval, writer, clock.now)
+
+
+def start_acquisition():
+    '''Start reading and saving the sensors in the background, depending on conf.acquisition either
+    all from one scheduler thread, with one thread per sensor, or from a scheduler in a separate process.
+    The files are written by the background writer.
+    '''
+    if conf.acquisition == 'process':
+        acquisition_workers.append(fork.Process(target=acquisition_process, name='acquisition'))
+        acquisition_workers[-1].start()
+        return
+    open_files()
+    if conf.acquisition == 'scheduler':
+        acquisition_workers.append(threading.Thread(target=scheduler.run, name='scheduler'))
+        acquisition_workers[-1].start()
+    else:
+        for sensor in sensors:
+            sensor.start_thread()
+            acquisition_workers.append(sensor.thread)
+
+
+def acquisition_process():
+    '''Read and save the sensors until stopped, run as separate process forked from the main process.
+    It inherits the opened sensors and the shared control and estimate blocks,
+    but only touches the I2C bus and the data files.
+    '''
+    log_queue.start()  # the listener thread of the main process is not forked along
+    open_files()
+    try:
+        scheduler.run()
+    finally:
+        close_files()
+        pf.save(datafilename+'_acquisition_events.bin')
+        log_queue.stop()
+
+
+def open_files():
+    '''Open the data and telemetry files, and start the writer.'''
+    if recorder:
+        recorder.open()
+    for sensor in sensors:
+        sensor.open()
+    telemetry.open()
+    writer.start()
+
+
+def close_files():
+    '''Write the last telemetry, stop the writer, close the files, and log the acquisition summaries.'''
+    telemetry.submit(sensors)
+    writer.close()
+    if recorder:
+        recorder.close()  # with the last index, before the shared file is closed below
+    for sensor in sensors:
+        sensor.file.close()
+    telemetry.file.close()
+    logger.debug('Acquisition summary: '+telemetry.summary(sensors))
+    logger.debug('Writer summary: '+writer.report())
+
+
+def stop_acquisition():
+    '''Stop the acquisition, and wait for it and the writer to save the last data.'''
+    stop.set()
+    if not acquisition_workers:
+        logger.warning('Stopping the acquisition failed, because it was not started', exc_info=False)
+        return
+    for worker in acquisition_workers:
+        worker.join()
+    if conf.acquisition == 'process':
+        return  # the acquisition process closed its files and logged its summaries itself
+    close_files()
 
 
 @pf.profile
@@ -300,15 +626,15 @@ def wait_for_toggle(obj, timeout=None):
     Return True when the button was toggled in time, and False if the function times out.
     If the timeout was set to None (indefinite), return the time waited.
     '''
-    start = time.time()
+    start = time.monotonic()
     initial = obj.value
     obj.wait_for_release(timeout=timeout)
-    residual_timeout = start+timeout-time.time() or None
+    residual_timeout = start+timeout-time.monotonic() or None
     obj.wait_for_press(timeout=residual_timeout)
     if not initial:
-        residual_timeout = start+timeout-time.time() or None
+        residual_timeout = start+timeout-time.monotonic() or None
         obj.wait_for_release(timeout=residual_timeout)
-    end = time.time()
+    end = time.monotonic()
     if timeout == None:
         return end - start
     return end <= (start + timeout)
@@ -321,15 +647,21 @@ def default_blink(self, on_color=conf.white, off_color=(0,0,0)):
 # assign the shortcut function to the RGBLED class
 gpiozero.RGBLED.default_blink = default_blink
 
-# TODO: either clean this function up a bit or maybe integrate it with the Sensor class
 @pf.profile
 def sensors_present():
-    '''Check if all sensors are adressable'''
-    i2cout = subprocess.check_output(['/usr/sbin/i2cdetect', '-y', '1'], universal_newlines=True)
-    addresses = [hex(altimu10v5.lis3mdl.LIS3MDL.ADDR)[2:],
-                hex(altimu10v5.lps25h.LPS25H.ADDR)[2:],
-                hex(altimu10v5.lsm6ds33.LSM6DS33.ADDR)[2:]]
-    return all(map(lambda x: x in i2cout, addresses))
+    '''Check if all sensors are adressable, by reading their WHO_AM_I registers over the sensor bus.'''
+    return imu.present()
+
+
+def log_startup():
+    '''Log the duration of the startup phases, from the start of the process until entering IDLE.'''
+    start = clock.process_start()
+    previous = startup[0][1] if start is None else start
+    phases = []
+    for phase, end in startup:
+        phases.append('{} {:.0f} ms'.format(phase, (end-previous)/1e6))
+        previous = end
+    logger.debug('Startup: {}, total {:.0f} ms'.format(', '.join(phases), (previous-(start or startup[0][1]))/1e6))
 
 
 @pf.profile
@@ -382,16 +714,21 @@ file_handler.setLevel(logging.DEBUG)
 file_formatter = logging.Formatter(fmt='%(created)s %(levelname)-8s %(name)s:%(funcName)s: %(message)s')
 file_handler.setFormatter(file_formatter)
 
+# take the creation times of the log records from the shared clock
+logging.setLogRecordFactory(clock.log_record_factory)
+
 # create logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
-# add the handlers to the logger
-logger.addHandler(console_handler)
-logger.addHandler(except_handler)
-logger.addHandler(file_handler)
+# the handlers are run by a listener thread, so the log calls only enqueue their records
+log_queue = LogQueue(logger, [console_handler, except_handler, file_handler], conf.log_queue_size, conf.log_preformat)
+log_queue.start()
 
 # log initial message
 logger.info('Start of the log of {}'.format(conf.name))
+# used by the ground software to convert the monotonic sensor timestamps to wall time
+logger.debug('Clock anchor: wall_ns {wall_ns} monotonic_ns {monotonic_ns}'.format(**clock.anchor))
+startup.append(('logging', time.monotonic_ns()))
 
 
 # in case the pin number is None (null in json), a dummy object is assigned
@@ -401,23 +738,39 @@ status_LED = (gpiozero.RGBLED(*conf.status_LED_pins, pwm=True) if all(conf.statu
 arm_switch = (gpiozero.Button(conf.arm_switch_pin) if conf.arm_switch_pin else dummy.Input('arm_switch'))
 breakwire  = (gpiozero.Button(conf.breakwire_pin) if conf.breakwire_pin else dummy.Input('breakwire'))
 gpiobjects = [hatch, buzzer, status_LED, arm_switch]
+# plays the buzzer patterns in the background, so the state machine never blocks on them
+annunciator = Annunciator(buzzer, status_LED, conf.beep_period)
+startup.append(('outputs', time.monotonic_ns()))
 
+# the sensors are only probed and set up when arming, see setup_acquisition
 imu = altimu10v5.IMU()
-# automatic dummy assignment if the sensors are not present, to allow for easier testing
-if sensors_present():
-    baro = Sensor('baro', conf.sensor_intervals['baro'], imu.lps25h.get_barometer_raw)
-    acc  = Sensor('acc',  conf.sensor_intervals['acc'],  imu.lsm6ds33.get_accelerometer_raw)
-    gyro = Sensor('gyro', conf.sensor_intervals['gyro'], imu.lsm6ds33.get_gyroscope_raw)
-    mag  = Sensor('mag',  conf.sensor_intervals['mag'],  imu.lis3mdl.get_magnetometer_raw)
+sensors = []
+scheduler = writer = telemetry = None  # set up with the sensors
+recorder = None  # the single-file flight recorder, if the data_format is 'recorder'
+if conf.acquisition == 'process':
+    import multiprocessing  # only needed in this mode
+    # fork explicitly, as the acquisition process relies on inheriting the opened sensors
+    fork = multiprocessing.get_context('fork')
+    stop = fork.Event()
+    wakeup = fork.Event()
+    # the locks order the accesses to the shared memory between the cores, see sharedmem.SharedValues
+    control = sharedmem.SharedValues(['state'], lock=fork.Lock())  # written by the main process
+    control.write(states.index(state))
+    # the estimate is written by the acquisition process, so it needs shared memory
+    estimate = sharedmem.SharedValues(Estimate._fields[1:], lock=fork.Lock())
 else:
-    logger.debug('AltIMU10v5 sensors not present, the logged data will be generated by a dummy function')
-    baro = Sensor('baro', conf.sensor_intervals['baro'], dummy.Sensor('baro').get)
-    acc  = Sensor('acc',  conf.sensor_intervals['acc'],  dummy.Sensor('acc').get)
-    gyro = Sensor('gyro', conf.sensor_intervals['gyro'], dummy.Sensor('gyro').get)
-    mag  = Sensor('mag',  conf.sensor_intervals['mag'],  dummy.Sensor('mag').get)
-sensors = [baro, acc, gyro, mag]
-
-stop = threading.Event()
+    stop = threading.Event()
+    wakeup = threading.Event()
+    control = None
+    # the estimate is written by the baro thread, so a local buffer does, and the GIL orders the accesses
+    buffer = bytearray(sharedmem.SharedValues.size(Estimate._fields[1:]))
+    estimate = sharedmem.SharedValues(Estimate._fields[1:], buffer)
+# wake up the state machine on every change of the inputs, instead of waiting for the next poll
+for button in (arm_switch, breakwire):
+    button.when_pressed = wakeup.set
+    button.when_released = wakeup.set
+acquisition_workers = []  # threads or process
+startup.append(('events', time.monotonic_ns()))
 
 
 ########################################
@@ -425,22 +778,28 @@ stop = threading.Event()
 
 if __name__ == '__main__':
     try:
-        buzzer.progress()
-        start = time.time()
+        annunciator.progress()
         while update_statemachine() != 'stop':
             if conf.testing:
-                logger.debug('{}m and {}m/s'.format(h[1], v[1]))
-            time.sleep(max(0, (conf.statemachine_interval*conf.state_interval_factors[state]+start-time.time())))
-            start = time.time()
+                logger.debug('{}m and {}m/s'.format(snapshot.h, snapshot.v))
+                if state in ('IDLE', 'PREPARED'):
+                    reload_config()
+            # sleep until an input changes, a new barometer estimate arrives in flight, or a window edge passes
+            wakeup.wait(time_to_next_check())
+            wakeup.clear()
     except:
         logger.exception('main loop broke', exc_info=True)
     finally:
+        annunciator.close(timeout=5)
         for obj in gpiobjects:
             obj.close()
-        pf.save(datafilename+'_events.csv')
+        pf.save(datafilename+'_events.bin')
+        log_queue.stop()  # write the last log records
         if conf.testing:
-            a = pyprofile.Analyser(pf.events)
+            a = pyprofile.Analyser(pf)
             print(a.summary())
+            print(a.report())
+            print(a.thread_report())
             if conf.plot:
                 a.plot()
             sys.exit(0)
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+'''
+Asynchronous logging: a log call only puts its record on a bounded queue,
+and a listener thread passes the records on to the handlers (console and log file),
+so logging from the state machine or the sensor loops does no formatting or file I/O on the calling thread.
+'''
+
+import queue
+import logging
+import logging.handlers
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that never blocks: when the queue is full, the record is dropped and counted.
+With preformat, the message is merged with its arguments (and an exception rendered) by the caller,
+like the standard QueueHandler does, so mutable arguments are logged as they were at the call.
+Otherwise the record is queued as it is, leaving all formatting to the listener.'''
+    def __init__(self, queue, preformat=False):
+        super().__init__(queue)
+        self.preformat = preformat
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        if self.preformat:
+            return super().prepare(record)
+        return record
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    '''QueueListener that waits for room in a full queue when stopping, instead of failing to stop.'''
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class LogQueue:
+    '''Logs the records of a logger to the given handlers from a listener thread,
+through a queue of at most maxsize records (see DroppingQueueHandler).'''
+    def __init__(self, logger, handlers, maxsize=1000, preformat=False):
+        self.logger = logger
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.handler = DroppingQueueHandler(queue.Queue(maxsize), preformat)
+        self.listener = None
+        logger.addHandler(self.handler)
+
+    def start(self):
+        '''Start the listener thread. Also to be called in a forked process, which doesn't inherit the thread,
+        and gets a queue of its own.
+        '''
+        self.handler.queue = queue.Queue(self.maxsize)
+        self.listener = DrainingQueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        '''Pass the queued records on to the handlers, stop the listener thread,
+        and log the number of dropped records, if any, directly to the handlers.
+        '''
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        if self.handler.dropped:
+            record = self.logger.makeRecord(self.logger.name, logging.WARNING, __file__, 0,
+                                            '{} log records were dropped, because the log queue was full'
+                                            .format(self.handler.dropped), None, None, 'stop')
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
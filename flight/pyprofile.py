@@ -7,67 +7,288 @@ which can later be exported and plotted.
 '''
 
 import time
-import csv
+import json
+import struct
+import itertools
+import threading
+from array import array
+
+import flightdata
 
 
 class Profiler:
-    def __init__(self):
-        self.events = []
+    '''Records the start and stop events of the decorated functions in a preallocated ring of capacity events,
+so profiling costs no allocations, and the memory use stays constant however long it runs.
+The timestamps are integer nanoseconds, taken with the given clock function.
+The function names (prefixed by the name attribute of the object for methods, like 'baro read')
+are interned to integer ids, and every event is stored as timestamp, code = 2*id + kind (0 start, 1 stop),
+the identifier of the calling thread, and the CPU time of that thread (time.thread_time_ns),
+so the analysis can tell CPU work from time spent blocked (on I2C, sleeping or waiting for the GIL).
+
+Profiling can be switched off at runtime with the enabled attribute, and with sample_every = N
+(fixed when decorating) only one in N calls per function is recorded. A profiler created with enabled False returns the functions
+undecorated, so they run without any overhead.'''
+    def __init__(self, clock=time.monotonic_ns, capacity=100000, sample_every=1, enabled=True):
+        self.clock = clock
+        # a profiler created disabled never records an event, so it doesn't need the ring
+        self.capacity = capacity if enabled else 1
+        self.sample_every = sample_every
+        self.enabled = enabled
+        self.decorate = enabled  # whether profile wraps the functions at all
+        self.names = []  # function name per id
+        self.ids = {}  # id per function name
+        # repeating a one element array allocates the ring in place, without a temporary buffer of its size
+        self.times = array('q', [0])*self.capacity
+        self.codes = array('i', [0])*self.capacity
+        self.threads = array('Q', [0])*self.capacity
+        self.cpu_times = array('q', [0])*self.capacity
+        self.thread_names = {}  # name per thread identifier, added at the first event of the thread
+        # claiming a slot with next() is atomic, so threads can't overwrite each other's events
+        self._slots = itertools.count()
+
+    def intern(self, name):
+        '''Return the id of a function name, adding it if it is new.'''
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
 
     def profile(self, func):
         '''Returns a function that wraps the input argument with two calls,
-that log the start and end time of the function to a general events list'''
-        def wrapped(*args, **kwargs):
-            try:
-                objname = args[0].name+' '
-            except:
-                objname = ''
-            self.events.append([time.time(), objname+func.__name__, 'start'])
-            ret = func(*args, **kwargs)
-            self.events.append([time.time(), objname+func.__name__, 'stop'])
-            return ret
+that log the start and end time of the function to the events ring.
+Methods (with self as first argument) get one id per object name, interned at their first call.'''
+        if not self.decorate:
+            return func
+        # bound to locals, as every lookup counts at thousands of calls per second
+        clock, times, codes, threads, cpu_times, slots, capacity = \
+            self.clock, self.times, self.codes, self.threads, self.cpu_times, self._slots, self.capacity
+        get_ident, thread_time, thread_names = threading.get_ident, time.thread_time_ns, self.thread_names
+        sample_every, calls = self.sample_every, itertools.count()
+        if func.__code__.co_varnames[:1] == ('self',):
+            start_codes = {}  # start code per object
+            def wrapped(obj, *args, **kwargs):
+                if not self.enabled or (sample_every > 1 and next(calls) % sample_every):
+                    return func(obj, *args, **kwargs)
+                code = start_codes.get(obj)
+                if code is None:
+                    code = start_codes[obj] = 2*self.intern(getattr(obj, 'name', type(obj).__name__)+' '+func.__name__)
+                thread = get_ident()
+                if thread not in thread_names:
+                    thread_names[thread] = threading.current_thread().name
+                i = next(slots) % capacity
+                times[i] = clock()
+                cpu_times[i] = thread_time()
+                codes[i] = code
+                threads[i] = thread
+                ret = func(obj, *args, **kwargs)
+                i = next(slots) % capacity
+                cpu_times[i] = thread_time()
+                times[i] = clock()
+                codes[i] = code+1
+                threads[i] = thread
+                return ret
+        else:
+            code = 2*self.intern(func.__name__)
+            def wrapped(*args, **kwargs):
+                if not self.enabled or (sample_every > 1 and next(calls) % sample_every):
+                    return func(*args, **kwargs)
+                thread = get_ident()
+                if thread not in thread_names:
+                    thread_names[thread] = threading.current_thread().name
+                i = next(slots) % capacity
+                times[i] = clock()
+                cpu_times[i] = thread_time()
+                codes[i] = code
+                threads[i] = thread
+                ret = func(*args, **kwargs)
+                i = next(slots) % capacity
+                cpu_times[i] = thread_time()
+                times[i] = clock()
+                codes[i] = code+1
+                threads[i] = thread
+                return ret
+        wrapped.__name__ = func.__name__
+        wrapped.__doc__ = func.__doc__
         return wrapped
 
+    def ring(self):
+        '''Return the recorded (timestamp, code, thread, CPU time) events in the ring, oldest first.'''
+        # the count can only be read by claiming a slot, which is filled with a marker code that is skipped
+        total = next(self._slots)
+        self.times[total % self.capacity] = self.clock()
+        self.codes[total % self.capacity] = -1
+        n = min(total+1, self.capacity)
+        first = (total+1-n) % self.capacity
+        order = itertools.chain(range(first, self.capacity), range(first)) if n == self.capacity else range(n)
+        return [(self.times[i], self.codes[i], self.threads[i], self.cpu_times[i]) for i in order if self.codes[i] >= 0]
+
+    @property
+    def events(self):
+        '''List of the recorded events as [timestamp, function name, 'start'/'stop', thread, CPU time], oldest first.'''
+        return [[t, self.names[code >> 1], ('start', 'stop')[code & 1], thread, cpu] for t, code, thread, cpu in self.ring()]
+
     def save(self, out_file):
-        '''Saves the events list to a csv file'''
-        if not out_file.endswith('.csv'):
-            out_file = out_file+'.csv'
-        with open(out_file, 'w') as f:
-            csv.writer(f).writerows(self.events)
+        '''Saves the events ring to a binary file, in the flight data format (see flightdata.py)
+with timestamp, code, thread and CPU time per event, and the function and thread names in the header.'''
+        if not out_file.endswith('.bin'):
+            out_file = out_file+'.bin'
+        with open(out_file, 'wb') as f:
+            writer = flightdata.RecordWriter(f, 'events', ['timestamp', 'code', 'thread', 'cpu'], '<qiQq',
+                                             metadata={'names': self.names, 'threads': self.thread_names})
+            writer.writerows(self.ring())
+
+
+# numpy equivalents of the struct format characters of the events files
+DTYPES = {'q': '<i8', 'i': '<i4', 'Q': '<u8'}
+
+
+def read_header(f):
+    '''Read the header of an opened file written by Profiler.save, and return it and the offset of the first event.'''
+    if f.read(len(flightdata.MAGIC)) != flightdata.MAGIC:
+        raise ValueError('{} is not a profiler events file'.format(f.name))
+    length, = struct.unpack('<I', f.read(4))
+    return json.loads(f.read(length).decode()), len(flightdata.MAGIC)+4+length
+
+
+def load_events(path):
+    '''Return the header and the events of a file written by Profiler.save, as numpy structured array.'''
+    import numpy as np
+    with open(path, 'rb') as f:
+        header, offset = read_header(f)
+        f.seek(0)
+        data = f.read()
+    dtype = np.dtype([(column, DTYPES[char]) for column, char in zip(header['columns'], header['format'].lstrip('<'))])
+    return header, np.frombuffer(data, dtype, (len(data)-offset)//dtype.itemsize, offset)
 
 
 class Analyser:
+    '''Pairs the start and stop events of the profiled functions, vectorized with numpy,
+so the events of a full flight can be analysed in seconds.
+The events are paired per function and thread, where nested (recursive) calls are matched by their depth,
+and a stop whose start was overwritten in the ring is ignored. Starts without stop are unfinished calls.
+Per thread, every call is assigned its innermost enclosing call as parent,
+to get the self time (excluding the profiled functions it called) besides the inclusive time.
+With the CPU time of the threads recorded, the wall time of the calls is split in CPU time
+and blocked time, which is spent waiting on I/O (like I2C transfers), sleeping, or waiting for the GIL.
+
+data_in can be a Profiler, a list of events as in Profiler.events (the thread and CPU time being optional),
+or the path to a binary file, as written by the save function of the Profiler.
+All times are converted to seconds.'''
     def __init__(self, data_in):
-        '''data_in should either be a list of events, as generated by the Profiler,
-or it should be the path to a csv file, as written by the save function of the Profiler'''
-        try:
-            with open(data_in, 'r') as f:
-                str_events = list(csv.reader(f))
-            self.events = [(float(event[0]), *event[1:]) for event in str_events]
-        except TypeError:
-            self.events = data_in  # [[timestamp, function_name, start/stop], ...]
-            assert isinstance(self.events, list)
-        self.start = self.events[0][0]  # use first entry as t0 for plotting
-
-        # dictionary of relative call times and duration per function
-        self.data = {}  # {'function_name':[(time_start, duration), ...], ...}
-        for row in self.events:
-            if row[1] in self.data:
-                if row[2] == 'start':
-                    self.data[row[1]].append((row[0]-self.start, None))
-                elif row[2] == 'stop':
-                    self.data[row[1]][-1] = (self.data[row[1]][-1][0], row[0]-self.start-self.data[row[1]][-1][0])
-            else:
-                self.data[row[1]] = [(row[0]-self.start, None)]
-        # filtering the data for finished and unfinished events
-        self.finished_data = {k:[] for k in self.data.keys()}  # same as self.data
-        self.unfinished_data = {k:[] for k in self.data.keys()}  # {'function_name': [time_start, ...]}
-        for i, dataset in enumerate(self.data):
-            for entry in self.data[dataset]:
-                if None in entry:  # if the event is missing an end time, it is unfinished
-                    self.unfinished_data[dataset].append(entry[0])
-                else:
-                    self.finished_data[dataset].append(entry)
+        # only import numpy if we actually need it, so we don't use it during flight
+        global np
+        import numpy as np
+
+        if isinstance(data_in, str):
+            header, records = load_events(data_in)
+            self.names = header['names']
+            thread_names = {int(thread): name for thread, name in header.get('threads', {}).items()}
+            times, codes = records['timestamp'], records['code'].astype(np.int64)
+            threads = records['thread'] if 'thread' in records.dtype.names else np.zeros(len(records), np.uint64)
+            cpu = records['cpu'] if 'cpu' in records.dtype.names else None
+        elif isinstance(data_in, Profiler):
+            self.names = list(data_in.names)
+            thread_names = dict(data_in.thread_names)
+            ring = data_in.ring()
+            times, codes, threads, cpu = (np.array(column) for column in zip(*ring)) if ring else (np.zeros(0, np.int64),)*4
+        else:
+            self.names = sorted(set(event[1] for event in data_in))
+            thread_names = {}
+            ids = {name: i for i, name in enumerate(self.names)}
+            times = np.array([event[0] for event in data_in], dtype=np.int64)
+            codes = np.array([2*ids[event[1]] + (event[2] == 'stop') for event in data_in], dtype=np.int64)
+            threads = np.array([event[3] if len(event) > 3 else 0 for event in data_in], dtype=np.uint64)
+            cpu = np.array([event[4] for event in data_in], dtype=np.int64) if all(len(event) > 4 for event in data_in) \
+                  else None
+
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]/1e9
+        self.functions = codes[order] >> 1
+        self.starts = (codes[order] & 1) == 0
+        self.cpu = cpu[order]/1e9 if cpu is not None else None
+        self.thread_ids, self.threads = np.unique(threads[order], return_inverse=True)
+        self.thread_names = [thread_names.get(int(thread), 'thread {}'.format(i))
+                             for i, thread in enumerate(self.thread_ids)]
+        # use first entry as t0 for plotting, without events (profiling disabled) all statistics are empty
+        self.start = self.times[0] if len(self.times) else 0
+        self.end = self.times[-1] if len(self.times) else 0
+        self._pair()
+        self._nest()
+
+    def _pair(self):
+        '''Pair the start and stop events per function and thread into calls.'''
+        # group the events by thread and function, keeping the time order within the groups
+        order = np.lexsort((self.times, self.functions, self.threads))
+        key = self.threads[order]*len(self.names) + self.functions[order]
+        boundaries = np.flatnonzero(np.diff(key))+1
+        call_starts, call_stops, unfinished = [], [], []
+        for group in np.split(order, boundaries):
+            starts = self.starts[group]
+            step = np.where(starts, 1, -1)
+            depth = np.cumsum(step)
+            # a stop that reaches a new minimum depth belongs to a start that was overwritten in the ring
+            floor = np.minimum.accumulate(np.minimum(depth, 0))
+            orphan = ~starts & (depth == floor) & (np.concatenate(([0], floor[:-1])) > floor)
+            group, starts, step = group[~orphan], starts[~orphan], step[~orphan]
+            depth = np.cumsum(step)
+            # starts and stops of the same call have the same level, and alternate when sorted by level
+            level = np.where(starts, depth, depth+1)
+            by_level = np.lexsort((self.times[group], level))
+            group, starts, level = group[by_level], starts[by_level], level[by_level]
+            paired = starts[:-1] & ~starts[1:] & (level[:-1] == level[1:])
+            call_starts.append(group[:-1][paired])
+            call_stops.append(group[1:][paired])
+            matched = np.zeros(len(group), bool)
+            matched[:-1] |= paired
+            matched[1:] |= paired
+            unfinished.append(group[starts & ~matched])
+        call_starts, call_stops = np.concatenate(call_starts), np.concatenate(call_stops)
+        by_start = np.argsort(self.times[call_starts], kind='stable')
+        self.call_start = self.times[call_starts[by_start]]
+        self.call_duration = self.times[call_stops[by_start]] - self.call_start
+        self.call_function = self.functions[call_starts[by_start]]
+        self.call_thread = self.threads[call_starts[by_start]]
+        if self.cpu is not None:
+            self.call_cpu = self.cpu[call_stops[by_start]] - self.cpu[call_starts[by_start]]
+        else:
+            self.call_cpu = np.full(len(by_start), np.nan)
+        unfinished = np.sort(np.concatenate(unfinished))
+        self.unfinished_start = self.times[unfinished]
+        self.unfinished_function = self.functions[unfinished]
+
+    def _nest(self):
+        '''Find the parent of every call, and sum the durations of the children to get the self times.'''
+        n = len(self.call_start)
+        self.call_parent = np.full(n, -1)
+        child_time = np.zeros(n)
+        for thread in range(len(self.thread_ids)):
+            calls = np.flatnonzero(self.call_thread == thread)
+            # depth of the calls in the thread: number of calls started before, minus the ones stopped before
+            starts = self.call_start[calls]
+            stops = starts + self.call_duration[calls]
+            depth = np.arange(len(calls)) - np.searchsorted(np.sort(stops), starts, side='right')
+            for d in range(1, depth.max()+1 if len(calls) else 0):
+                children, parents = calls[depth == d], calls[depth == d-1]
+                # the parent is the last call one level up that started before the child
+                index = np.searchsorted(self.call_start[parents], self.call_start[children], side='right')-1
+                valid = index >= 0
+                self.call_parent[children[valid]] = parents[index[valid]]
+        has_parent = self.call_parent >= 0
+        np.add.at(child_time, self.call_parent[has_parent], self.call_duration[has_parent])
+        self.call_self = self.call_duration - child_time
+
+    @property
+    def finished_data(self):
+        '''{'function_name': [(time_start, duration), ...], ...}, with the time relative to the first event.'''
+        return {name: list(zip(self.call_start[self.call_function == i]-self.start,
+                               self.call_duration[self.call_function == i]))
+                for i, name in enumerate(self.names)}
+
+    @property
+    def unfinished_data(self):
+        '''{'function_name': [time_start, ...], ...}, with the time relative to the first event.'''
+        return {name: list(self.unfinished_start[self.unfinished_function == i]-self.start)
+                for i, name in enumerate(self.names)}
 
     def plot(self, bar_height_fraction=0.9):
         '''Plots the timeline as a horizontal bar chart,
@@ -76,21 +297,135 @@ with unfinished events as triangles to indicate the start.'''
         global plt
         from matplotlib import pyplot as plt
 
+        finished_data, unfinished_data = self.finished_data, self.unfinished_data
         colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
         plt.xlabel('Elapsed time [s]')
-        plt.yticks(ticks=range(1, 2*len(self.data.keys())+1, 2), labels=self.data.keys())
-        for i, dataset in enumerate(self.finished_data):
+        plt.yticks(ticks=range(1, 2*len(self.names)+1, 2), labels=self.names)
+        for i, dataset in enumerate(self.names):
             color = colors[i%len(colors)]
-            plt.scatter(self.unfinished_data[dataset], [2*i+1]*len(self.unfinished_data[dataset]), marker='>', c=color)
-            plt.broken_barh(self.finished_data[dataset], (2*i+(1-bar_height_fraction), bar_height_fraction*2), facecolor=color)
+            plt.scatter(unfinished_data[dataset], [2*i+1]*len(unfinished_data[dataset]), marker='>', c=color)
+            plt.broken_barh(finished_data[dataset], (2*i+(1-bar_height_fraction), bar_height_fraction*2), facecolor=color)
         plt.show()
 
+    def statistics(self):
+        '''Returns a dict per function name with the number of finished calls,
+the total, mean, 50th, 95th and 99th percentile and maximum of the inclusive duration,
+and the total self time (excluding the profiled functions it called), all in seconds.'''
+        stats = {}
+        for i, name in enumerate(self.names):
+            selected = self.call_function == i
+            durations = self.call_duration[selected]
+            if not len(durations):
+                stats[name] = {'count': 0}
+                continue
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            stats[name] = {'count': len(durations), 'total': durations.sum(), 'mean': durations.mean(),
+                           'p50': p50, 'p95': p95, 'p99': p99, 'max': durations.max(),
+                           'self': self.call_self[selected].sum()}
+        return stats
+
+    def report(self):
+        '''Returns the statistics as a table, with the durations in milliseconds.'''
+        lines = ['{:<28} {:>8} {:>10} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8}'\
+                 .format('function', 'count', 'total', 'self', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for name, s in sorted(self.statistics().items(), key=lambda item: -item[1].get('total', 0)):
+            if s['count']:
+                lines.append('{:<28} {:>8} {:>10.1f} {:>10.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'\
+                             .format(name, s['count'], *(1000*s[key] for key in
+                                                         ('total', 'self', 'mean', 'p50', 'p95', 'p99', 'max'))))
+        return '\n'.join(lines)
+
+    def thread_statistics(self):
+        '''Returns a dict per (function name, thread name) with the number of finished calls,
+and the total wall time, CPU time, and blocked time (wall minus CPU time) in seconds.'''
+        stats = {}
+        key = self.call_function*len(self.thread_ids) + self.call_thread
+        count = np.bincount(key, minlength=len(self.names)*len(self.thread_ids))
+        wall = np.bincount(key, self.call_duration, minlength=len(count))
+        cpu = np.bincount(key, self.call_cpu, minlength=len(count))
+        for i in np.flatnonzero(count):
+            name, thread = self.names[i // len(self.thread_ids)], self.thread_names[i % len(self.thread_ids)]
+            stats[name, thread] = {'count': count[i], 'wall': wall[i], 'cpu': cpu[i], 'blocked': wall[i]-cpu[i]}
+        return stats
+
+    def thread_report(self):
+        '''Returns the thread statistics as a table, with the times in milliseconds.'''
+        lines = ['{:<28} {:<16} {:>8} {:>10} {:>10} {:>10} {:>6}'\
+                 .format('function', 'thread', 'count', 'wall', 'cpu', 'blocked', 'cpu %')]
+        for (name, thread), s in sorted(self.thread_statistics().items(), key=lambda item: (item[0][1], -item[1]['wall'])):
+            lines.append('{:<28} {:<16} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>6.1f}'\
+                         .format(name, thread, s['count'], 1000*s['wall'], 1000*s['cpu'], 1000*s['blocked'],
+                                 100*s['cpu']/s['wall'] if s['wall'] else 0))
+        return '\n'.join(lines)
+
     def summary(self):
         '''Returns a summary of the data:
 - total time
 - total fraction of the total time any of the functions was running
 - which fraction of the total time each function ran'''
-        total_time = self.events[-1][0] - self.start
-        fractions = {dataset: sum([entry[1] for entry in self.finished_data[dataset]])/total_time for dataset in self.data}
+        total_time = self.end - self.start
+        totals = np.bincount(self.call_function, self.call_duration, minlength=len(self.names))
+        fractions = {name: totals[i]/total_time if total_time else 0 for i, name in enumerate(self.names)}
         total_fraction = sum(fractions.values())
         return total_time, total_fraction, fractions
+
+
+def export_trace(out_file, events_files, log_file=None, chunk_size=100000):
+    '''Export the events files written by Profiler.save as Chrome trace event JSON,
+which can be opened in chrome://tracing or ui.perfetto.dev to zoom through the timeline of a full flight.
+Every events file (e.g. of the main and the acquisition process) becomes a process, and every thread a track,
+with the calls as begin and end events. If the flight log is given, the state transitions in it are added
+as global instant events, converted to the monotonic clock with the clock anchor in the log.
+The events are streamed in chunks of chunk_size, so the trace is never built in memory.'''
+    with open(out_file, 'w') as out:
+        out.write('[\n')
+        separator = ''
+        for pid, path in enumerate(events_files):
+            out.write(separator + json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                                              'args': {'name': path.rsplit('/', 1)[-1]}}))
+            separator = ',\n'
+            with open(path, 'rb') as f:
+                header, offset = read_header(f)
+                record = struct.Struct(header['format'])
+                # the json encoded names of the begin and end events, by code
+                names = [json.dumps(name) for name in header['names']]
+                threads = {}  # track number per thread identifier
+                thread_names = header.get('threads', {})
+                while True:
+                    data = f.read(chunk_size*record.size)
+                    data = data[:len(data)//record.size*record.size]
+                    if not data:
+                        break
+                    lines = []
+                    for event in record.iter_unpack(data):
+                        timestamp, code = event[:2]
+                        thread = event[2] if len(event) > 2 else 0
+                        if thread not in threads:
+                            threads[thread] = len(threads)
+                            name = thread_names.get(str(thread), 'thread {}'.format(threads[thread]))
+                            lines.append('{{"name":"thread_name","ph":"M","pid":{},"tid":{},"args":{{"name":{}}}}}'
+                                         .format(pid, threads[thread], json.dumps(name)))
+                        lines.append('{{"name":{},"ph":"{}","ts":{:.3f},"pid":{},"tid":{}}}'
+                                     .format(names[code >> 1], 'BE'[code & 1], timestamp/1000, pid, threads[thread]))
+                    out.write(separator + separator.join(lines))
+        if log_file:
+            anchor, transitions = None, []
+            for line in open(log_file):
+                words = line.split()
+                if 'Clock anchor:' in line:
+                    anchor = int(words[-3]), int(words[-1])
+                elif len(words) > 3 and words[1] == 'INFO' and words[-2] == 'to':
+                    transitions.append((float(words[0]), words[-3]+' to '+words[-1]))
+            if anchor:
+                for created, name in transitions:
+                    timestamp = created*1e9 - anchor[0] + anchor[1]
+                    out.write(separator + json.dumps({'name': name, 'ph': 'i', 's': 'g', 'ts': timestamp/1000,
+                                                      'pid': 0, 'tid': 0}))
+        out.write('\n]\n')
+
+
+if __name__ == '__main__':
+    # usage: python3 pyprofile.py trace.json events.bin [acquisition_events.bin ...] [flight.log]
+    import sys
+    export_trace(sys.argv[1], [path for path in sys.argv[2:] if path.endswith('.bin')],
+                 next((path for path in sys.argv[2:] if path.endswith('.log')), None))
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+'''
+Single-file flight recorder: the data of all sensors is appended to one container file,
+as interleaved chunks that are checked with a CRC and numbered, so a power cut can only tear the last chunk,
+and an index of the chunks is appended periodically, so readers can seek to a sensor and time range.
+
+The file starts with a header like the binary flight data files (see flightdata.py), with the magic MAGIC
+and the session metadata (name, clock anchor and configuration), followed by the chunks:
+- the chunk header CHUNK: the magic CHUNK_MAGIC, the kind of the chunk, the stream number, the sequence number
+  (counting all chunks of the file), the number of rows, the first and last timestamp, and the payload length,
+  followed by the CRC32 of the chunk header and the payload
+- the payload, depending on the kind:
+  - STREAM: the JSON header of a stream (one per sensor), like the header of a compressed flight data file
+  - DATA: the rows of one write of a stream, encoded like a chunk of a compressed flight data file
+  - INDEX: the offset of the previous index chunk (-1 for the first), followed by one INDEX_ENTRY
+    per chunk written since: the kind, stream, sequence number, first and last timestamp, and offset of the chunk
+- an index chunk is followed by the TRAILER: the magic TRAILER_MAGIC and the offset of the index chunk,
+  which is the end of the file until more chunks are appended, and can be searched for from the end otherwise
+
+The index chunks are linked backwards, so a reader finds all chunks up to the last index from the end of the file,
+and only has to check the chunks after it. The ground software reads the file with ground/recorder.py.
+'''
+
+import json
+import time
+import zlib
+import struct
+import flightdata
+
+MAGIC = b'SRPREC01'
+CHUNK_MAGIC = b'SRPK'
+CHUNK = struct.Struct('<4sBxHIIqqI')  # magic, kind, stream, sequence, rows, first, last timestamp, payload length
+CRC = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<BxHIqqQ')  # kind, stream, sequence, first, last timestamp, offset
+TRAILER_MAGIC = b'SRPINDEX'
+TRAILER = struct.Struct('<8sQ')  # magic, offset of the index chunk
+STREAM, DATA, INDEX = 0, 1, 2  # chunk kinds
+
+
+def encode_header(metadata=None):
+    '''Return the file header bytes with the session metadata, padded like in the binary flight data files.'''
+    header = json.dumps(metadata or {}).encode()
+    padding = -(len(MAGIC)+4+len(header)) % 8
+    return MAGIC + struct.pack('<I', len(header)+padding) + header + b' '*padding
+
+
+class Recorder:
+    '''Appends the chunks of all streams to one file, and an index of them every index_interval seconds
+and when closing. The chunks are written from one thread (the background writer), the streams are opened before.'''
+    def __init__(self, filename, metadata=None, index_interval=5):
+        self.filename = filename
+        self.metadata = metadata  # session metadata for the file header
+        self.index_interval = index_interval
+        self.file = None
+        self.streams = []  # names of the streams, numbered in order of opening
+        self.sequence = 0  # sequence number of the next chunk
+        self.pending = []  # index entries of the chunks written since the last index chunk
+        self.last_index = -1  # offset of the last index chunk
+        self.next_index = 0
+
+    def open(self):
+        '''Open the file for appending, and return it to be closed by the caller (or with close).'''
+        self.file = open(self.filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(encode_header(self.metadata))
+        self.next_index = time.monotonic() + self.index_interval
+        return self.file
+
+    def stream(self, name, columns, fmt, metadata=None, compression='zlib', level=None):
+        '''Declare a stream, and return its writer, with writerows like a csv.writer.'''
+        writer = StreamWriter(self, len(self.streams), fmt, compression, level)
+        self.streams.append(name)
+        header = {'name': name, 'columns': columns, 'format': fmt, **(metadata or {}),
+                  'compression': compression, 'delta': writer.delta}
+        self.write_chunk(STREAM, writer.stream, 0, 0, 0, json.dumps(header).encode())
+        return writer
+
+    def write_chunk(self, kind, stream, rows, first, last, payload):
+        '''Append one chunk, and return its offset.'''
+        offset = self.file.tell()
+        header = CHUNK.pack(CHUNK_MAGIC, kind, stream, self.sequence, rows, first, last, len(payload))
+        self.file.write(header + CRC.pack(zlib.crc32(payload, zlib.crc32(header))) + payload)
+        if kind != INDEX:
+            self.pending.append(INDEX_ENTRY.pack(kind, stream, self.sequence, first, last, offset))
+        self.sequence += 1
+        return offset
+
+    def write_rows(self, stream, rows, payload):
+        '''Append the encoded rows of a stream as a data chunk, followed by an index if it is due.'''
+        self.write_chunk(DATA, stream, len(rows), rows[0][0], rows[-1][0], payload)
+        if time.monotonic() >= self.next_index:
+            self.write_index()
+
+    def write_index(self):
+        '''Append an index chunk of the chunks written since the last one, and the trailer pointing to it.'''
+        payload = struct.pack('<q', self.last_index) + b''.join(self.pending)
+        self.last_index = self.write_chunk(INDEX, 0, len(self.pending), 0, 0, payload)
+        self.file.write(TRAILER.pack(TRAILER_MAGIC, self.last_index))
+        self.pending = []
+        self.next_index = time.monotonic() + self.index_interval
+
+    def close(self):
+        '''Append the last index, and close the file.'''
+        if self.file and not self.file.closed:
+            if self.pending:
+                self.write_index()
+            self.file.close()
+
+
+class StreamWriter:
+    '''Writes the rows of one stream as delta encoded and compressed data chunks, like flightdata.ChunkWriter.'''
+    def __init__(self, recorder, stream, fmt, compression='zlib', level=None):
+        self.recorder = recorder
+        self.stream = stream
+        self.typecodes = fmt.lstrip('<')
+        self.delta = [typecode in flightdata.INTEGER_TYPECODES for typecode in self.typecodes]
+        self.compress = flightdata.compressor(compression, level)
+
+    def writerows(self, rows):
+        '''Encode and append the rows as one chunk.'''
+        if rows:
+            self.recorder.write_rows(self.stream, rows,
+                                     self.compress(flightdata.encode_columns(rows, self.typecodes, self.delta)))
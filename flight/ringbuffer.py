@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+'''
+Fixed-size ring buffer for sensor samples, so the memory use of a sensor stays constant,
+no matter how long the rocket waits on the pad.
+'''
+
+import itertools
+from array import array
+
+
+class RingBuffer:
+    '''Stores up to capacity rows, column-wise in preallocated typed arrays (one typecode per column,
+as used by the array and struct modules, e.g. 'd' for the timestamp and 'h' for int16 channels).
+Rows are numbered by a running index (total number of rows appended so far),
+which readers use to fetch the rows appended since their last read.
+When a reader falls more than capacity rows behind, the oldest rows are overwritten.
+
+The running index and the columns are stored in one buffer, which can be given
+(e.g. a shared memory block of at least RingBuffer.size bytes), so other processes can read the rows.
+The running index is only incremented after the row is written, so it serves as sequence counter.'''
+    def __init__(self, capacity, typecodes, buffer=None):
+        self.capacity = capacity
+        self.typecodes = typecodes
+        view = memoryview(buffer if buffer is not None else bytearray(self.size(capacity, typecodes)))
+        self._total = view[:8].cast('q')
+        self.columns = []
+        offset = 8
+        for typecode in typecodes:
+            itemsize = array(typecode).itemsize
+            offset = -(-offset//itemsize)*itemsize  # align the column to its item size
+            self.columns.append(view[offset:offset+capacity*itemsize].cast(typecode))
+            offset += capacity*itemsize
+
+    @staticmethod
+    def size(capacity, typecodes):
+        '''Return the number of bytes needed for the buffer.'''
+        return 8 + sum(capacity*array(typecode).itemsize + array(typecode).itemsize for typecode in typecodes)
+
+    @property
+    def total(self):
+        '''Running index: the number of rows appended so far.'''
+        return self._total[0]
+
+    def __len__(self):
+        '''Number of rows currently stored.'''
+        return min(self.total, self.capacity)
+
+    def append(self, timestamp, values):
+        '''Append a row of a timestamp and a sequence of values.'''
+        total = self._total[0]
+        i = total % self.capacity
+        columns = self.columns
+        columns[0][i] = timestamp
+        for j, value in enumerate(values, 1):
+            columns[j][i] = value
+        self._total[0] = total+1
+
+    def extend(self, rows):
+        '''Append a list of rows, each starting with the timestamp.'''
+        for row in rows:
+            total = self._total[0]
+            i = total % self.capacity
+            for column, value in zip(self.columns, row):
+                column[i] = value
+            self._total[0] = total+1
+
+    def get(self, index, column):
+        '''Return one value of the newest rows by negative index (-1 being the newest row), in O(1).'''
+        total = self._total[0]
+        if not -min(total, self.capacity) <= index < 0:
+            raise IndexError('ring buffer index out of range')
+        return self.columns[column][(total+index) % self.capacity]
+
+    def find(self, value, column=0):
+        '''Return the running index of the first stored row with at least value in a column sorted in ascending order
+        (like the timestamps), or the total if there is none, by binary search in O(log n).
+        '''
+        total = self._total[0]
+        values = self.columns[column]
+        low, high = max(0, total-self.capacity), total
+        while low < high:
+            middle = (low+high)//2
+            if values[middle % self.capacity] < value:
+                low = middle+1
+            else:
+                high = middle
+        return low
+
+    def since(self, start):
+        '''Return the rows appended since the running index start as a list of tuples,
+        and the number of those rows that were already overwritten.
+        '''
+        total = self._total[0]
+        lost = max(0, total-start-self.capacity)
+        start += lost
+        first, last = start % self.capacity, total % self.capacity
+        if total - start == 0:
+            return [], lost
+        if first < last:
+            return list(zip(*[column[first:last] for column in self.columns])), lost
+        # the rows wrap around the end of the arrays
+        return list(zip(*[itertools.chain(column[first:], column[:last]) for column in self.columns])), lost
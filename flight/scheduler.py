@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+'''Single-threaded acquisition scheduler, that reads and saves all sensors from one thread,
+so the sensors don't contend for the GIL and their accesses to the shared I2C bus are serialized.'''
+
+import time
+import heapq
+import logging
+
+# because this is a module to be imported, make this logger a child of the main file's logger
+logger = logging.getLogger('__main__.'+__name__)
+
+
+class Scheduler:
+    '''Service the reads and saves of a list of sensors (see fly.Sensor) until the stop event is set.
+It keeps a min-heap of the next read deadline per sensor. All sensors that are due are read
+in rate-monotonic order (shortest interval first), and rescheduled one (state dependent) interval later.
+When a read finishes after the next deadline of its sensor has already passed,
+the skipped periods are counted as missed deadlines and the sensor is realigned to its schedule.
+The timing of every read is recorded in the sensor's loop statistics (see telemetry.LoopStats).
+The optional tick function is called every loop, e.g. to follow the state of another process.'''
+    def __init__(self, sensors, stop, tick=None):
+        self.sensors = sensors
+        self.stop = stop
+        self.tick = tick
+
+    def run(self):
+        '''Read and save the sensors until the stop event is set, then save the remaining data.
+        The files of the sensors need to be opened before.
+        '''
+        start = time.monotonic()
+        # heap entries are (deadline, interval, index in self.sensors)
+        heap = [(start, sensor.interval, i) for i, sensor in enumerate(self.sensors)]
+        heapq.heapify(heap)
+        next_save = [start+sensor.save_interval for sensor in self.sensors]
+
+        while not self.stop.is_set():
+            if self.tick:
+                self.tick()
+            now = time.monotonic()
+            if heap[0][0] > now:
+                # waiting on the event instead of sleeping, to return immediately when stopped
+                self.stop.wait(heap[0][0]-now)
+                continue
+            due = []
+            while heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap))
+            for deadline, interval, i in sorted(due, key=lambda entry: entry[1]):
+                sensor = self.sensors[i]
+                start = time.monotonic()
+                sensor.read()
+                if start > next_save[i]:
+                    sensor.save()
+                    next_save[i] += sensor.save_interval
+                interval = sensor.interval
+                now = time.monotonic()
+                missed = 0
+                if deadline+interval <= now:
+                    missed = int((now-deadline-interval)//interval)+1
+                sensor.stats.record(start, now-start, interval, start-deadline, missed)
+                heapq.heappush(heap, (deadline+(missed+1)*interval, interval, i))
+
+        for sensor in self.sensors:
+            sensor.save()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+'''
+Shared memory for running the sensor acquisition in a separate process (acquisition "process" in the config),
+so it runs in parallel to the state machine on a multi-core Pi, with its own GIL.
+The blocks are created before the acquisition process is forked, which inherits them.
+Only the flight state and the barometer estimate are shared, the sensor rows stay in the acquisition process.
+'''
+
+import mmap
+
+
+def create(size):
+    '''Return a new anonymous shared memory block of size bytes, shared with the processes forked afterwards.
+    It is unmapped when the last process using it exits, so it needs no cleanup.
+    '''
+    return mmap.mmap(-1, size, flags=mmap.MAP_SHARED)
+
+
+class SharedValues:
+    '''A fixed set of named float values, published by one writer and read by any process or thread.
+The values are guarded by a sequence counter (seqlock): the writer makes it odd while writing,
+and even again when done, and readers retry when it was odd or changed during their read.
+If no buffer (of at least SharedValues.size bytes) is given, a new shared memory block is created.
+Between threads of one process, a local buffer like a bytearray does as well.
+
+Without a lock, the seqlock relies on the stores of the writer becoming visible in order.
+Between threads that holds, as the GIL is released and taken with memory barriers.
+Between processes on a multi-core ARM CPU (like a Pi 3 or 4), plain stores to the mmap have no barriers,
+so a reader could see a new counter with old values. A lock (like multiprocessing.Lock) is then given,
+which is held around writing and reading, and whose semaphore operations are the barriers.
+The writer only holds it for the few stores of one write, and a reader that can't get it within
+lock_timeout seconds (because the writer died holding it) falls back to the seqlock.'''
+    def __init__(self, names, buffer=None, lock=None, lock_timeout=1):
+        self.names = names
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        if buffer is None:
+            buffer = create(self.size(names))
+        view = memoryview(buffer)
+        self._seq = view[:8].cast('q')
+        self._values = view[8:8+8*len(names)].cast('d')
+
+    @staticmethod
+    def size(names):
+        '''Return the number of bytes needed for the buffer.'''
+        return 8 + 8*len(names)
+
+    @property
+    def count(self):
+        '''The number of completed writes, readable without a retry or the lock, to check for new values before
+        reading them (it may lag behind the writer for a moment without the barriers of the lock).
+        '''
+        return self._seq[0]//2
+
+    def write(self, *values):
+        '''Publish a new set of values, in the order of the names.'''
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self._seq[0] += 1
+            for i, value in enumerate(values):
+                self._values[i] = value
+            self._seq[0] += 1
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def read(self, retries=1000):
+        '''Return the number of writes so far, and a consistent list of the values.
+        If the writer keeps interfering (or died while writing), the last read values are returned after
+        the given number of retries, as a possibly inconsistent set is better than hanging the caller.
+        '''
+        if self.lock is not None and self.lock.acquire(timeout=self.lock_timeout):
+            try:
+                return self._seq[0]//2, self._values.tolist()
+            finally:
+                self.lock.release()
+        for i in range(retries):
+            seq = self._seq[0]
+            if not seq % 2:
+                values = self._values.tolist()
+                if self._seq[0] == seq:
+                    return seq//2, values
+        return seq//2, self._values.tolist()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+'''
+Timing telemetry of the sensor acquisition: running statistics of the read loop per sensor,
+kept in constant memory, and written periodically to a compact csv stream next to the data files,
+so a rate regression is visible from a single flight without reprocessing the sensor data.
+'''
+
+import csv
+import bisect
+
+
+class LoopStats:
+    '''Running timing statistics of the read loop of one sensor:
+- the achieved read rate
+- a histogram of the intervals between the starts of consecutive reads, in fixed bins
+- overruns: loop iterations where the read and save took longer than the interval
+- the lateness of the reads after their deadline (worst case and mean), and the number of missed deadlines
+All times are in seconds.'''
+    # upper edges of the interval histogram bins, the last bin is everything longer
+    EDGES = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1)
+
+    def __init__(self):
+        self.reads = 0
+        self.first = None  # start of the first read
+        self.last = None  # start of the last read
+        self.histogram = [0]*(len(self.EDGES)+1)
+        self.overruns = 0
+        self.missed = 0
+        self.max_lateness = 0
+        self.total_lateness = 0
+        self.max_duration = 0
+
+    def record(self, start, duration, interval, lateness=0, missed=0):
+        '''Add one loop iteration that started at start, and took duration for reading and saving,
+        lateness after its deadline, with missed deadlines skipped afterwards.
+        '''
+        if self.last is None:
+            self.first = start
+        else:
+            self.histogram[bisect.bisect_left(self.EDGES, start-self.last)] += 1
+        self.last = start
+        self.reads += 1
+        if duration > interval:
+            self.overruns += 1
+        self.missed += missed
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.total_lateness += lateness
+        self.max_duration = max(self.max_duration, duration)
+
+    @property
+    def rate(self):
+        '''Achieved reads per second.'''
+        if self.reads < 2 or self.last == self.first:
+            return 0
+        return (self.reads-1)/(self.last-self.first)
+
+    def row(self, dropped=0):
+        '''Return the counters as a row of the telemetry stream (without the timestamp and name),
+        with the given number of rows dropped by the writer.
+        '''
+        return [self.reads, self.overruns, self.missed, round(1e6*self.max_lateness), round(1e6*self.max_duration),
+                dropped, *self.histogram]
+
+    def summary(self):
+        '''Return a one line summary string.'''
+        return '{:.1f} Hz, {} overruns, {} missed deadlines, lateness max {:.1f} ms mean {:.2f} ms, '\
+               'max read+save {:.1f} ms, intervals {}'\
+               .format(self.rate, self.overruns, self.missed, 1000*self.max_lateness,
+                       1000*self.total_lateness/max(1, self.reads), 1000*self.max_duration,
+                       ' '.join('<={:g}ms:{}'.format(1000*edge, n) for edge, n in zip(self.EDGES, self.histogram)
+                                if n) + (' >1s:{}'.format(self.histogram[-1]) if self.histogram[-1] else ''))
+
+
+class Telemetry:
+    '''Writes the loop statistics of the sensors to a csv file through the background writer,
+at most every interval seconds per sensor, as rows of
+timestamp, sensor name, reads, overruns, missed deadlines, max lateness [us], max read+save duration [us],
+rows dropped by the writer, followed by the interval histogram counts (see LoopStats.EDGES).
+The counters are cumulative, so the rates between two rows are their differences.'''
+    def __init__(self, filename, interval, writer, clock):
+        self.name = 'telemetry'
+        self.filename = filename
+        self.interval = interval
+        self.writer = writer
+        self.clock = clock  # timestamp function
+        self.file = None
+        self.csv_writer = None
+        self.next_update = {}
+
+    def open(self):
+        '''Open the telemetry file for appending, and return it to be closed by the caller.'''
+        self.file = open(self.filename, 'a')
+        self.csv_writer = csv.writer(self.file)
+        return self.file
+
+    def update(self, sensor, now):
+        '''Submit the statistics of a sensor if its last row is older than the interval.
+        now is the time in seconds of time.monotonic.
+        '''
+        if now >= self.next_update.get(sensor.name, 0):
+            self.next_update[sensor.name] = now+self.interval
+            self.submit([sensor])
+
+    def submit(self, sensors):
+        '''Submit the statistics of the sensors to the writer.'''
+        timestamp = self.clock()
+        dropped = self.writer.dropped_rows
+        self.writer.submit(self, [[timestamp, sensor.name, *sensor.stats.row(dropped.get(sensor.name, 0))]
+                                  for sensor in sensors])
+
+    def write(self, rows):
+        '''Write rows to the file, called from the writer thread.'''
+        self.csv_writer.writerows(rows)
+        self.file.flush()
+
+    def summary(self, sensors):
+        '''Return a summary string with one part per sensor.'''
+        return '; '.join('{}: {}'.format(sensor.name, sensor.stats.summary()) for sensor in sensors)
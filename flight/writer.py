@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+'''
+Background writer, that writes the sensor data to storage from a dedicated thread,
+so a stalling SD card delays the writing instead of the sensor readings.
+'''
+
+import os
+import time
+import queue
+import threading
+import logging
+
+# because this is a module to be imported, make this logger a child of the main file's logger
+logger = logging.getLogger('__main__.'+__name__)
+
+
+class Writer:
+    '''Writes the rows that the reading threads hand over with submit, from its own thread.
+The rows are copied out of the sensor's ring buffer when submitted (the second buffer),
+so the readers can continue filling the ring buffer while the rows are written.
+The handover queue is bounded to max_backlog batches, and submit never blocks:
+when the queue is full, the batch is dropped and counted instead.
+
+The durability policy decides when the written files are fsynced, besides when closing:
+- 'flush': only flush the files after each write, leaving the rest to the OS
+- 'interval': fsync the written files every fsync_interval seconds
+- 'transition': fsync the written files when sync is called, i.e. on every state transition'''
+    POLICIES = ('flush', 'interval', 'transition')
+
+    def __init__(self, policy='interval', fsync_interval=5, max_backlog=100):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown fsync policy {}, choose from {}'.format(policy, self.POLICIES))
+        self.policy = policy
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue(max_backlog)
+        self.thread = None
+        self.dirty = set()  # files written since the last fsync
+        # instrumentation
+        self.writes = 0  # number of batches written
+        self.dropped = 0  # number of rows dropped because the queue was full
+        self.dropped_rows = {}  # the same per sensor name, for the telemetry
+        self.lock = threading.Lock()  # the sensor threads submit concurrently, guards the counters they update
+        self.max_backlog = 0  # highest number of batches waiting in the queue
+        self.total_latency = 0  # summed time from submitting to finishing the write of each batch
+        self.max_latency = 0
+        self.fsyncs = 0
+        self.fsync_time = 0  # summed time spent in fsync
+
+    def start(self):
+        '''Start the writer thread.'''
+        self.thread = threading.Thread(target=self.run, name='writer')
+        self.thread.start()
+
+    def submit(self, sensor, rows):
+        '''Hand over rows to be written with sensor.write, without blocking.
+        Return False if they were dropped, because the writer is too far behind.
+        '''
+        try:
+            self.queue.put_nowait(('write', time.monotonic(), sensor, rows))
+        except queue.Full:
+            with self.lock:
+                self.dropped += len(rows)
+                self.dropped_rows[sensor.name] = self.dropped_rows.get(sensor.name, 0) + len(rows)
+            return False
+        backlog = self.queue.qsize()
+        with self.lock:
+            self.max_backlog = max(self.max_backlog, backlog)
+        return True
+
+    def sync(self):
+        '''Request an fsync of the written files, after the writes submitted so far, if the policy is 'transition'.'''
+        if self.policy == 'transition':
+            try:
+                self.queue.put_nowait(('sync', time.monotonic(), None, None))
+            except queue.Full:
+                pass  # the writer is behind anyway, the fsync will be done when closing
+
+    def close(self):
+        '''Write all submitted rows, fsync the files, and stop the writer thread.'''
+        self.queue.put(('stop', time.monotonic(), None, None))
+        self.thread.join()
+
+    def fsync(self):
+        '''Fsync all files written since the last fsync.'''
+        start = time.monotonic()
+        for file in self.dirty:
+            os.fsync(file.fileno())
+        self.dirty.clear()
+        self.fsyncs += 1
+        self.fsync_time += time.monotonic()-start
+
+    def run(self):
+        '''Write the submitted batches until closed.'''
+        last_fsync = time.monotonic()
+        while True:
+            kind, submitted, sensor, rows = self.queue.get()
+            if kind == 'stop':
+                break
+            if kind == 'sync':
+                self.fsync()
+                continue
+            try:
+                sensor.write(rows)
+                self.dirty.add(sensor.file)
+            except (OSError, ValueError):
+                logger.exception('Writing the data of {} failed'.format(sensor.name))
+            now = time.monotonic()
+            self.writes += 1
+            self.total_latency += now-submitted
+            self.max_latency = max(self.max_latency, now-submitted)
+            if self.policy == 'interval' and now-last_fsync > self.fsync_interval:
+                self.fsync()
+                last_fsync = time.monotonic()
+        self.fsync()
+
+    def report(self):
+        '''Return a string with the writer statistics.'''
+        return '{} writes, mean latency {:.1f} ms, max latency {:.1f} ms, max backlog {}, {} rows dropped, '\
+               '{} fsyncs taking {:.1f} ms in total'\
+               .format(self.writes, 1000*self.total_latency/max(1, self.writes), 1000*self.max_latency,
+                       self.max_backlog, self.dropped, self.fsyncs, 1000*self.fsync_time)
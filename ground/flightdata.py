@@ -0,0 +1,138 @@
+'''
+Reader for the binary flight data files written by flight/flightdata.py.
+
+The records are mapped into memory as a numpy structured array, without parsing them,
+and can be converted to the legacy csv format on demand.
+Compressed files (with 'compression' in the header) are decoded chunk by chunk, see iter_chunks.
+Usage as script: python3 flightdata.py file.bin [file.bin ...] to convert to csv files next to them.
+'''
+
+import sys
+import csv
+import json
+import lzma
+import zlib
+import struct
+import numpy as np
+
+MAGIC = b'SRPDATA1'
+CHUNK_MAGIC = b'SRPC'
+CHUNK = struct.Struct('<4sII')  # magic, number of rows, length of the payload
+DECOMPRESSORS = {'zlib': zlib.decompress, 'lzma': lzma.decompress}
+
+# numpy equivalents of the struct format characters used in the records
+DTYPES = {'d': '<f8', 'f': '<f4', 'q': '<i8', 'i': '<i4', 'h': '<i2', 'b': 'i1', 'B': 'u1'}
+
+
+def read_header(path):
+    '''Return the header dict of a binary flight data file, and the offset of the first record.'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a binary flight data file'.format(path))
+        length, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(length).decode())
+    return header, len(MAGIC) + 4 + length
+
+
+def record_dtype(header):
+    '''Return the numpy structured dtype of one record.'''
+    return np.dtype([(column, DTYPES[char]) for column, char in zip(header['columns'], header['format'].lstrip('<'))])
+
+
+def decode_chunk(header, dtype, n_rows, payload):
+    '''Return the records of one decompressed chunk payload as a numpy structured array.'''
+    records = np.empty(n_rows, dtype=dtype)
+    offset = 0
+    for name, delta in zip(dtype.names, header['delta']):
+        column = np.frombuffer(payload, dtype=dtype[name], count=n_rows, offset=offset)
+        offset += column.nbytes
+        # the cumulative sum wraps around like the differences did when encoding
+        records[name] = np.cumsum(column, dtype=column.dtype) if delta else column
+    return records
+
+
+def iter_chunks(path):
+    '''Yield the records of a compressed flight data file chunk by chunk, as numpy structured arrays,
+    so files larger than memory can be streamed. A torn chunk at the end (from a power cut) is ignored.
+    '''
+    header, offset = read_header(path)
+    dtype = record_dtype(header)
+    decompress = DECOMPRESSORS[header['compression']]
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            chunk_header = f.read(CHUNK.size)
+            if len(chunk_header) < CHUNK.size:
+                return
+            magic, n_rows, length = CHUNK.unpack(chunk_header)
+            payload = f.read(length)
+            if magic != CHUNK_MAGIC or len(payload) < length:
+                return
+            try:
+                payload = decompress(payload)
+            except (zlib.error, lzma.LZMAError):
+                return
+            yield decode_chunk(header, dtype, n_rows, payload)
+
+
+def load(path):
+    '''Return the header and the records of a binary flight data file as a read-only numpy memmap,
+    or as an array for a compressed file.
+    A torn record at the end (from a power cut during writing) is ignored.
+    '''
+    header, offset = read_header(path)
+    dtype = record_dtype(header)
+    if 'compression' in header:
+        chunks = list(iter_chunks(path))
+        return header, (np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype))
+    with open(path, 'rb') as f:
+        n_records = (f.seek(0, 2) - offset)//dtype.itemsize
+    if n_records == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(n_records,))
+
+
+def rebase(timestamps, anchor):
+    '''Return monotonic nanosecond timestamps as wall time in seconds since the epoch,
+    using the clock anchor of the session (see flight/clock.py).
+    '''
+    return (np.asarray(timestamps, dtype=np.int64) - anchor['monotonic_ns'])/1e9 + anchor['wall_ns']/1e9
+
+
+def load_data(path, physical=False):
+    '''Return the columns of a binary flight data file as a 2D float array (one row per column),
+    like post.load_data does for csv files.
+    The monotonic nanosecond timestamps are rebased to wall time in seconds with the clock anchor in the header,
+    the offsets in the header are subtracted (e.g. the gyro calibration),
+    and if physical is True, the values are also converted to physical units with the scale factors.
+    '''
+    header, records = load(path)
+    columns = np.array([records[column] for column in header['columns']], dtype=float)
+    if 'clock' in header:
+        columns[0] = rebase(records[header['columns'][0]], header['clock'])
+    columns -= np.array(header.get('offset', [0]*len(columns)), dtype=float)[:, np.newaxis]
+    if physical:
+        columns *= np.array(header.get('scale', [1]*len(columns)), dtype=float)[:, np.newaxis]
+    return columns
+
+
+def to_csv(path, out_path=None):
+    '''Convert a binary flight data file to the legacy csv format (raw values minus the offsets),
+    and return the path of the csv file.
+    '''
+    header, offset = read_header(path)
+    # compressed files are converted chunk by chunk, the others are mapped as a whole
+    chunks = iter_chunks(path) if 'compression' in header else [load(path)[1]]
+    out_path = out_path or path.rsplit('.', 1)[0] + '.csv'
+    offsets = header.get('offset', [0]*len(header['columns']))
+    with open(out_path, 'w') as f:
+        writer = csv.writer(f)
+        for records in chunks:
+            for record in records.tolist():
+                writer.writerow([value - offset if offset else value for value, offset in zip(record, offsets)])
+    return out_path
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        print(to_csv(path))
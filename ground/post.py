@@ -5,6 +5,8 @@ import numpy as np
 import scipy as sp
 import sys
 from matplotlib import pyplot as plt
+import flightdata
+import recorder
 
 plt.style.use("ggplot")
 
@@ -23,6 +25,30 @@ def load_data(name):
     return datapoints
 
 
+def load_sensor(path, anchor=None):
+    """Loads the data of one sensor from the flight recorder file or its binary file if one exists, or from its csv file otherwise.
+    The monotonic nanosecond timestamps of the csv files are rebased to wall time with the clock anchor from the log"""
+    prefix, name = path.rsplit('_', 1)
+    if os.path.exists(prefix + '.rec'):
+        with recorder.Recording(prefix + '.rec') as recording:
+            return recording.load_data(name)
+    if os.path.exists(path + '.bin'):
+        return flightdata.load_data(path + '.bin')
+    data = load_data(path + '.csv')
+    if anchor:
+        data[0] = (data[0] - anchor['monotonic_ns']) / 1e9 + anchor['wall_ns'] / 1e9
+    return data
+
+
+def read_clock_anchor(log):
+    """Returns the clock anchor logged at the start of the flight software, or None for logs from before the monotonic clock"""
+    for line in open(log):
+        if "Clock anchor:" in line:
+            words = line.split()
+            return {"wall_ns": int(words[-3]), "monotonic_ns": int(words[-1])}
+    return None
+
+
 def read_log(log):
     states = {"START": [], "IDLE": [], "PREPARED": [], "ARMED": [], "LAUNCHED": [], "DEPLOYED": []}
     loglines = open(log).readlines()
@@ -103,7 +129,8 @@ def calculate_alt_vv(baro_data, conf, states):
     altitude = [conf["T0"] / conf["a"] * ((p / p0) ** (-(conf["R"] * conf["a"]) / conf["g0"]) - 1)
                 for p in pressure_smoothed]
     print(altitude)
-    vertical_velocity = [0] + [(alt - altitude[i]) / conf["sensor_intervals"]['baro'] for i, alt in
+    # the time steps are taken from the timestamps, as only new barometer conversions are logged
+    vertical_velocity = [0] + [(alt - altitude[i]) / (baro_data[0][i + 1] - baro_data[0][i]) for i, alt in
                                enumerate(altitude[1:])]  # conversion from h to vv
     vertical_velocity_smoothed = [vertical_velocity[0]]
     for i, vv in enumerate(vertical_velocity[1:]):
@@ -149,6 +176,7 @@ if __name__ == '__main__':
     with open(data_path + datafilename + '_config.json') as config_file:
         conf = json.load(config_file)
     states = read_log(data_path + datafilename + '.log')
+    anchor = read_clock_anchor(data_path + datafilename + '.log')
 
     n_plots = len(conf["sensor_intervals"].keys())
     n_rows = int(math.sqrt(n_plots))
@@ -156,8 +184,14 @@ if __name__ == '__main__':
     fig, axs = plt.subplots(n_rows, n_cols)
     fig.suptitle('Raw sensor readings', fontsize=20)
     sensors = {}
+    if conf.get("imu_fifo"):
+        # the gyro and accelerometer samples were drained together from the FIFO into one file
+        imu = load_sensor(data_path + datafilename + "_imu", anchor)
+        sensors['gyro'] = imu[[0, 1, 2, 3]]
+        sensors['acc'] = imu[[0, 4, 5, 6]]
     for i, name in enumerate(conf["sensor_intervals"].keys()):
-        sensors[name] = load_data(data_path + datafilename + "_" + name + '.csv')
+        if name not in sensors:
+            sensors[name] = load_sensor(data_path + datafilename + "_" + name, anchor)
         ax = axs[i // n_cols, i % n_cols]
         ax.set_title(name)
         lim = [sys.maxsize, -sys.maxsize]
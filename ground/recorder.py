@@ -0,0 +1,233 @@
+'''
+Reader for the single-file flight recorder written by flight/recorder.py.
+
+The chunk index is read from the end of the file, following the links between the index chunks,
+and only the chunks after the last index are checked one by one, so opening a file doesn't scan it.
+A sensor's time window is read from the chunks overlapping it, found by bisecting the index.
+A torn or corrupt chunk (from a power cut) ends the file, recover truncates the file after the last good chunk.
+Usage as script: python3 recorder.py [--recover] file.rec [file.rec ...]
+to convert the streams to csv files next to them, or only to truncate the files to their good chunks.
+'''
+
+import os
+import sys
+import csv
+import json
+import zlib
+import struct
+import bisect
+import numpy as np
+import flightdata
+
+MAGIC = b'SRPREC01'
+CHUNK_MAGIC = b'SRPK'
+CHUNK = struct.Struct('<4sBxHIIqqI')  # magic, kind, stream, sequence, rows, first, last timestamp, payload length
+CRC = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<BxHIqqQ')  # kind, stream, sequence, first, last timestamp, offset
+TRAILER_MAGIC = b'SRPINDEX'
+TRAILER = struct.Struct('<8sQ')  # magic, offset of the index chunk
+STREAM, DATA, INDEX = 0, 1, 2  # chunk kinds
+SEARCH_BLOCK = 1 << 16  # bytes read at a time when searching for the last trailer
+
+
+class Recording:
+    '''An opened recorder file, with the file header in header, the stream headers by name in streams,
+and the end of the last good chunk in end (the file size, unless the file ends with a torn chunk).'''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a flight recorder file'.format(path))
+        length, = struct.unpack('<I', self.file.read(4))
+        self.header = json.loads(self.file.read(length).decode())
+        self.start = len(MAGIC) + 4 + length
+        self.size = self.file.seek(0, 2)
+        # index entries (kind, stream, sequence, first, last timestamp, offset) of the good chunks, in file order
+        self.entries = []
+        index = self.find_index()
+        if index is None:
+            # no index was written (yet), so all chunks are checked
+            self.end, sequence = self.start, 0
+        else:
+            self.entries = self.read_index(index)
+            self.end, sequence = index[0] + CHUNK.size + CRC.size + index[1] + TRAILER.size, index[2] + 1
+        self.scan(sequence)
+        self.streams = {}  # stream header by name
+        self.times = {}  # first and last timestamps, and offsets, of the data chunks of each stream by name
+        names = {}  # by stream number
+        for kind, stream, sequence, first, last, offset in self.entries:
+            if kind == STREAM:
+                header = json.loads(self.read_chunk(offset)[1].decode())
+                header['dtype'] = flightdata.record_dtype(header)
+                self.streams[header['name']] = header
+                self.times[header['name']] = ([], [], [])
+                names[stream] = header['name']
+            elif kind == DATA:
+                for times, value in zip(self.times[names[stream]], (first, last, offset)):
+                    times.append(value)
+
+    def close(self):
+        '''Close the file.'''
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read_chunk(self, offset):
+        '''Return the header fields and the payload of the chunk at offset,
+        or None if it is torn or corrupt (a wrong magic, a short read or a wrong CRC).
+        '''
+        self.file.seek(offset)
+        header = self.file.read(CHUNK.size)
+        crc = self.file.read(CRC.size)
+        if len(header) < CHUNK.size or len(crc) < CRC.size:
+            return None
+        fields = CHUNK.unpack(header)
+        payload = self.file.read(fields[-1])
+        if fields[0] != CHUNK_MAGIC or len(payload) < fields[-1] \
+           or CRC.unpack(crc)[0] != zlib.crc32(payload, zlib.crc32(header)):
+            return None
+        return fields, payload
+
+    def index_at(self, offset):
+        '''Return (offset, payload length, sequence number) of a good index chunk at offset, or None.'''
+        if not self.start <= offset < self.size:
+            return None
+        chunk = self.read_chunk(offset)
+        if chunk is None or chunk[0][1] != INDEX:
+            return None
+        return offset, chunk[0][-1], chunk[0][3]
+
+    def find_index(self):
+        '''Return the last good index chunk (see index_at) that its trailer points to, or None if there is none.
+        The trailer is at the end of the file, unless more chunks were written after it, then it is searched
+        for backwards, which reads about the chunks of one index interval.
+        '''
+        end = self.size
+        while end > self.start:
+            begin = max(self.start, end - SEARCH_BLOCK)
+            self.file.seek(begin)
+            # overlap the blocks by a trailer, so no trailer is split between two of them
+            block = self.file.read(min(end + TRAILER.size, self.size) - begin)
+            position = len(block)
+            while True:
+                position = block.rfind(TRAILER_MAGIC, 0, position)
+                if position < 0:
+                    break
+                trailer = block[position:position + TRAILER.size]
+                if len(trailer) == TRAILER.size:
+                    index = self.index_at(TRAILER.unpack(trailer)[1])
+                    if index and index[0] + CHUNK.size + CRC.size + index[1] == begin + position:
+                        return index
+                position += len(TRAILER_MAGIC) - 1
+            end = begin
+        return None
+
+    def read_index(self, index):
+        '''Return the entries of the index chunk at index and all before it, in file order.'''
+        entries = []
+        offset = index[0]
+        while offset >= 0:
+            payload = self.read_chunk(offset)[1]
+            offset, = struct.unpack_from('<q', payload)
+            entries[:0] = INDEX_ENTRY.iter_unpack(payload[8:])
+        return entries
+
+    def scan(self, sequence):
+        '''Check the chunks from self.end on, adding them to the entries, until the end of the file
+        or the first torn or corrupt chunk, or the first chunk out of sequence, and set end after the last good one.
+        '''
+        offset = self.end
+        while offset < self.size:
+            chunk = self.read_chunk(offset)
+            if chunk is None:
+                break
+            (magic, kind, stream, chunk_sequence, rows, first, last, length), payload = chunk
+            if chunk_sequence != sequence:
+                break
+            following = offset + CHUNK.size + CRC.size + length
+            if kind == INDEX:
+                following += TRAILER.size
+                if following > self.size:
+                    break
+            else:
+                self.entries.append((kind, stream, sequence, first, last, offset))
+            sequence += 1
+            offset = self.end = following
+
+    def read(self, name, start=None, end=None):
+        '''Return the records of a stream from timestamp start to end (both inclusive, None for unlimited),
+        as a numpy structured array. Only the data chunks overlapping the window are read and decoded.
+        The timestamps are the raw monotonic nanoseconds, see flightdata.rebase for the conversion to wall time.
+        '''
+        header = self.streams[name]
+        firsts, lasts, offsets = self.times[name]
+        # the chunks of a stream are written in time order, so both their first and last timestamps are sorted
+        begin = 0 if start is None else bisect.bisect_left(lasts, start)
+        stop = len(firsts) if end is None else bisect.bisect_right(firsts, end)
+        decompress = flightdata.DECOMPRESSORS[header['compression']]
+        chunks = []
+        for offset in offsets[begin:stop]:
+            chunk = self.read_chunk(offset)
+            if chunk is None:
+                continue  # corrupted after it was indexed, like a damaged sector
+            fields, payload = chunk
+            chunks.append(flightdata.decode_chunk(header, header['dtype'], fields[4], decompress(payload)))
+        records = np.concatenate(chunks) if chunks else np.zeros(0, dtype=header['dtype'])
+        timestamps = records[header['columns'][0]]
+        if start is not None:
+            records = records[timestamps >= start]
+            timestamps = records[header['columns'][0]]
+        if end is not None:
+            records = records[timestamps <= end]
+        return records
+
+    def load_data(self, name, start=None, end=None, physical=False):
+        '''Return the columns of a stream as a 2D float array (one row per column), like flightdata.load_data.'''
+        header = self.streams[name]
+        records = self.read(name, start, end)
+        columns = np.array([records[column] for column in header['columns']], dtype=float)
+        if 'clock' in self.header:
+            columns[0] = flightdata.rebase(records[header['columns'][0]], self.header['clock'])
+        columns -= np.array(header.get('offset', [0]*len(columns)), dtype=float)[:, np.newaxis]
+        if physical:
+            columns *= np.array(header.get('scale', [1]*len(columns)), dtype=float)[:, np.newaxis]
+        return columns
+
+
+def recover(path):
+    '''Truncate a recorder file after its last good chunk, and return the number of bytes removed.'''
+    with Recording(path) as recording:
+        end, size = recording.end, recording.size
+    if end < size:
+        os.truncate(path, end)
+    return size - end
+
+
+def to_csv(path):
+    '''Convert the streams of a recorder file to csv files next to it, like flightdata.to_csv,
+    and return their paths.
+    '''
+    paths = []
+    with Recording(path) as recording:
+        for name, header in recording.streams.items():
+            out_path = '{}_{}.csv'.format(path.rsplit('.', 1)[0], name)
+            offsets = header.get('offset', [0]*len(header['columns']))
+            with open(out_path, 'w') as f:
+                writer = csv.writer(f)
+                for record in recording.read(name).tolist():
+                    writer.writerow([value - offset if offset else value for value, offset in zip(record, offsets)])
+            paths.append(out_path)
+    return paths
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--recover']:
+        for path in sys.argv[2:]:
+            print('{}: {} bytes truncated'.format(path, recover(path)))
+    else:
+        for path in sys.argv[1:]:
+            print('\n'.join(to_csv(path)))